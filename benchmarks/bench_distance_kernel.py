@@ -0,0 +1,48 @@
+'''
+Benchmark of the matrix product distance kernel of mcmm.clustering against scipy.spatial.distance.cdist for the
+distance blocks of get_cluster_info (euclidean metric, k cluster centers).
+
+Usage: python benchmarks/bench_distance_kernel.py [dim ...] [--k 1000] [--n 20000] [--repeat 3]
+'''
+from __future__ import print_function
+import sys
+from timeit import default_timer as timer
+import numpy as np
+from scipy.spatial import distance
+from mcmm.clustering import DistanceKernel
+
+def best_time(function,repeat):
+    times = []
+    for i in range(repeat):
+        start = timer()
+        result = function()
+        times.append(timer() - start)
+    return min(times), result
+
+def run(n_samples,dim,k,repeat=3,dtype=None):
+    rng = np.random.RandomState(0)
+    data = rng.randn(n_samples,dim)
+    cluster_centers = data[rng.choice(n_samples,k,replace=False)] + 0.1*rng.randn(k,dim)
+    kernel = DistanceKernel(cluster_centers,dtype=dtype)
+    cdist_time, reference = best_time(lambda: distance.cdist(data,cluster_centers),repeat)
+    kernel_time, distances = best_time(lambda: kernel(data),repeat)
+    nearest_time, (labels, dist) = best_time(lambda: kernel.nearest(data),repeat)
+    same = np.array_equal(labels,np.argmin(reference,axis=1))
+    error = np.max(np.abs(distances - reference))
+    print('%4d  %-8s cdist %7.3fs  kernel %7.3fs  speedup %5.1fx  nearest %7.3fs  max error %.1e  same labels: %s'
+          % (dim,np.dtype(np.float64 if dtype is None else dtype).name,cdist_time,kernel_time,cdist_time/kernel_time,
+             nearest_time,error,same))
+
+def option(args,name,default):
+    return int(float(args[args.index(name) + 1])) if name in args else default
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    k = option(args,'--k',1000)
+    n_samples = option(args,'--n',20000)
+    repeat = option(args,'--repeat',3)
+    dims = [int(a) for i, a in enumerate(args) if not a.startswith('--') and (i == 0 or not args[i-1].startswith('--'))]
+    print('n=%d, k=%d' % (n_samples,k))
+    for dim in dims or [10, 30, 100]:
+        for dtype in [None, np.float32]:
+            run(n_samples,dim,k,repeat,dtype)
@@ -1,23 +1,55 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 __metaclass__ = type
 import numpy as np
-from scipy.spatial import distance
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import distance, cKDTree
 from timeit import default_timer as timer
-from datetime import timedelta
+import itertools
+from .common import *
+from .clustering import KDTREE_METRICS, DistanceKernel, chunk_slices, concat_list, get_cluster_info, paired_distances
+from .instrumentation import Instrumented
 
-class DBSCAN(object):
+class DBSCAN(Instrumented):
 
-    def __init__(self,data,eps,minPts,metric='euclidean',verbose=True):
+    def __init__(self,data,eps,minPts,metric='euclidean',verbose=True,engine='auto',graph=None,dtype=None,
+                 listeners=None):
         '''
         Classic density based spatial clustering with noise classification.
         Args:
-            data: (n,d)-shaped two-dimensional ndarray
+            data: (n,d)-shaped two-dimensional ndarray or list of such arrays with matching second dimension d.
+            Labels of list data are returned in lists accordingly.
             eps: epsilon neighborhood parameter
             minPts: minimal number of points in each neighborhood
+            engine: 'tree' answers neighborhood queries with a KD-tree, 'brute' computes distances to all points.
+            'auto' uses the KD-tree for the euclidean, cityblock and chebyshev metric and brute force otherwise.
+            'graph' builds the eps-neighborhood graph once (see NeighborhoodGraph) and derives the clusters from
+            connected components of its core points, which makes refits with other minPts cheap.
+            'grid' is an exact engine for euclidean data in up to 3 dimensions based on a grid of cells with side
+            eps/sqrt(d), see grid_clusters.
+            graph: NeighborhoodGraph of data and eps to reuse with the 'graph' engine, e.g. from another DBSCAN
+            instance. Implies engine='graph'.
+            dtype: numpy.float32 stores the data in single precision (KD-trees still keep a float64 copy of the
+            points they index) and computes the distance blocks of the brute force and graph engines in single
+            precision. None (default) keeps the data as given. Neighborhoods and links are always confirmed with
+            float64 distances as in mcmm.clustering.paired_distances, so all engines give the labels of the data
+            converted to dtype.
+            listeners: list of callables receiving the fit records, see mcmm.instrumentation.Instrumented
         '''
 
-        if type(data) is list:
-            raise NotImplementedError('DBSCAN is not list compatible yet')
+        self._data_type_list = type(data) is list
+        self._traj_list_indices = None
+        if self._data_type_list:
+            data, self._traj_list_indices = concat_list(data)
+        data = np.asarray(data, dtype=dtype)
+        if graph is not None:
+            engine = 'graph'
+        if engine not in ('auto', 'tree', 'brute', 'graph', 'grid'):
+            raise InvalidValue('Unknown DBSCAN engine %s' % engine)
+        if engine == 'grid' and (metric != 'euclidean' or data.shape[1] > 3):
+            raise InvalidValue('The grid engine requires euclidean data with at most 3 dimensions')
+        if graph is not None and (graph.eps != eps or graph.metric != metric or graph.n_samples != data.shape[0]):
+            raise InvalidValue('Neighborhood graph does not match data, eps and metric')
 
         self._data = data
         self._eps = eps
@@ -26,9 +58,17 @@ class DBSCAN(object):
         self._metric = metric
         self._n_clusters = None
         self._verbose = verbose
+        self._engine = engine
+        self._graph = graph
+        self._core_sample_indices = None
+        self._core_index = None
+        self._dtype = dtype
+        self._listeners = [] if listeners is None else list(listeners)
+        self._fitted = False
 
     @property
     def cluster_labels(self):
+        '''int32 array of cluster indices 0,...,n_clusters-1 with -1 marking noise, list of arrays for list data'''
         if self._cluster_labels is None:
                 self.fit()
         return self._cluster_labels
@@ -36,49 +76,264 @@ class DBSCAN(object):
     def cluster_labels(self,value):
         self._cluster_labels = value
 
-    def fit(self):
+    @property
+    def n_clusters(self):
+        if self._n_clusters is None:
+            self.fit()
+        return self._n_clusters
+
+    @property
+    def core_sample_indices(self):
+        '''indices of the core points, i.e. points with at least minPts points in their eps-neighborhood'''
+        if self._core_sample_indices is None:
+            self.fit()
+        return self._core_sample_indices
+
+    @property
+    def fitted(self):
+        return self._fitted
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def graph(self):
+        '''the NeighborhoodGraph used by the 'graph' engine, None for other engines'''
+        return self._graph
+
+    def fit(self,minPts=None):
         '''
-        classifies the data with DBSCAN algorithm
+        classifies the data with DBSCAN algorithm. Points that are not core points but lie in the neighborhood of a
+        core point are labeled with the first cluster reaching them, all other points are labeled as noise (-1).
+
+        minPts can be changed for a refit, the 'graph' engine then reuses its neighborhood graph.
         '''
+        if minPts is not None:
+            self._minPts = minPts
+
+        callback = self._callback()
+        start_time = timer()
+
+        [n_samples,dim] = self._data.shape
+        if self._engine == 'graph':
+            if self._graph is None:
+                self._graph = NeighborhoodGraph(self._data,self._eps,self._metric,dtype=self._dtype)
+                if callback is not None:
+                    callback('phase', phase='neighborhood_graph', wall_time=timer() - start_time)
+            cluster_labels, core, cluster_index = graph_clusters(self._graph,self._minPts)
+        elif self._engine == 'grid':
+            cluster_labels, core, cluster_index = grid_clusters(self._data,self._eps,self._minPts)
+        else:
+            cluster_labels, core, cluster_index = self._expand_clusters()
+
+        self._n_clusters = cluster_index
+        self._core_sample_indices = np.flatnonzero(core)
+        self._core_index = None
+        self._fitted = True
+        if self._data_type_list:
+            self.cluster_labels = np.split(cluster_labels, self._traj_list_indices[:-1])
+        else:
+            self.cluster_labels = cluster_labels
+        if callback is not None:
+            callback('fit', wall_time=timer() - start_time, n_clusters=cluster_index,
+                     noise_rate=np.count_nonzero(cluster_labels == -1)/n_samples)
+
+    def transform(self,data):
+        '''
+        Assigns new data to the fitted clusters: each point gets the label of its nearest core point if that is
+        closer than eps, otherwise it is labeled as noise (-1). The nearest core points are found by a KD-tree over
+        the core points for the euclidean, cityblock and chebyshev metric and by blocked brute force otherwise.
+        (Also fits to initial data, if not fitted before)
+        Args:
+            data: (n,d)-shaped ndarray or list consisting of ndarrays each with matching second dimension d
+        Returns:
+            int32 cluster labels for the passed data, in lists for list data
+        '''
+        if not self._fitted:
+            self.fit()
+        if type(data) is list:
+            return [self._assign(np.asarray(traj, dtype=self._dtype)) for traj in data]
+        return self._assign(np.asarray(data, dtype=self._dtype))
 
-        if self._verbose:
-            start_time = timer()
+    def _assign(self,data):
+        labels = self._cluster_labels
+        if self._data_type_list:
+            labels = np.concatenate(labels)
+        core_labels = labels[self._core_sample_indices]
+        if len(core_labels) == 0:
+            return np.full(data.shape[0], -1, dtype=np.int32)
+        core_points = self._data[self._core_sample_indices]
+        if self._metric in KDTREE_METRICS:
+            if self._core_index is None:
+                self._core_index = cKDTree(core_points)
+            core_dist, nearest = self._core_index.query(data, p=KDTREE_METRICS[self._metric],
+                                                        distance_upper_bound=self._eps)
+            nearest = np.minimum(nearest, len(core_labels) - 1)
+        else:
+            nearest, core_dist = get_cluster_info(data, core_points, self._metric, dtype=self._dtype)
+        return np.where(core_dist < self._eps, core_labels[nearest], -1).astype(np.int32)
 
+    def _expand_clusters(self):
+        '''
+        classic DBSCAN cluster expansion by region queries, returns labels, core point mask and number of clusters
+        '''
         # initialize variables
         [n_samples,dim] = self._data.shape
         visited = np.zeros(n_samples,dtype=bool)
-        cluster_labels = [None]*n_samples
+        cluster_labels = np.full(n_samples,-1,dtype=np.int32)
+        core = np.zeros(n_samples,dtype=bool)
+        queue = ClusterQueue(n_samples)
         cluster_index = 0
-        noise_counter = 0
+        region_query = RegionQuery(self._data,self._eps,self._metric,self._engine,self._dtype)
 
-        for i,observation in enumerate(self._data):
+        for i in range(n_samples):
             if visited[i]:
-                pass
-            else:
-                visited[i] = True
-                neighbor_indices = get_region(self._data,observation,self._eps,self._metric)
-                if len(neighbor_indices) < self._minPts:
-                    # mark as noise
-                    cluster_labels[i] = 'noise'
-                    noise_counter = noise_counter + 1
-                else:
-                    # move up to next cluster
-                    cluster_index = cluster_index + 1
-                    #-------------
-                    #expand cluster subalgorithm
-                    #-------------
-                    cluster_labels,visited=expand_cluster(self._data,i,neighbor_indices,cluster_labels,cluster_index,self._eps,self._minPts,visited,self._metric)
-
-
-        self.cluster_labels = cluster_labels
-        if self._verbose:
-            print('Detected %i clusters'%cluster_index)
-            elapsed_time = timer() - start_time
-            elapsed_time = timedelta(seconds=elapsed_time)
-            print('Finished after ' + str(elapsed_time))
-            noise_rate = noise_counter/n_samples
-            print('Rate of noise in dataset: %f'%noise_rate)
-        self._n_clusters = cluster_index
+                continue
+            visited[i] = True
+            neighbor_indices = region_query([i])[0]
+            if len(neighbor_indices) >= self._minPts:
+                core[i] = True
+                cluster_labels[i] = cluster_index
+                #-------------
+                #expand cluster subalgorithm
+                #-------------
+                expand_cluster(neighbor_indices,cluster_labels,cluster_index,self._minPts,visited,core,queue,region_query)
+                cluster_index = cluster_index + 1
+        return cluster_labels, core, cluster_index
+
+
+class ClusterQueue(object):
+    '''
+    FIFO queue of point indices for the cluster expansion. Every point can be queued at most once during a fit,
+    which is tracked by an in-queue bitmap, so a preallocated index buffer suffices.
+    '''
+
+    def __init__(self,n_samples):
+        self._buffer = np.empty(n_samples,dtype=np.intp)
+        self._queued = np.zeros(n_samples,dtype=bool)
+        self._head = 0
+        self._tail = 0
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def push(self,indices):
+        '''
+        appends the given indices that were never queued before
+        '''
+        indices = np.unique(indices[~self._queued[indices]])
+        self._queued[indices] = True
+        self._buffer[self._tail:self._tail+len(indices)] = indices
+        self._tail += len(indices)
+
+    def pop(self,size):
+        '''
+        removes and returns the next (at most) size indices
+        '''
+        batch = self._buffer[self._head:min(self._head+size, self._tail)]
+        self._head += len(batch)
+        return batch
+
+
+class RegionQuery(object):
+    '''
+    Answers eps-neighborhood queries (distance < eps) on fixed data. Uses a KD-tree (scipy.spatial.cKDTree) for the
+    metrics in mcmm.clustering.KDTREE_METRICS, see tree_regions, and distances to all points otherwise, computed for
+    blocks of queries by a mcmm.clustering.DistanceKernel over the data. Both give the neighborhoods of get_region.
+    '''
+
+    def __init__(self,data,eps,metric='euclidean',engine='auto',dtype=None):
+        '''
+        Args:
+            data: (n,d)-shaped ndarray
+            eps: neighborhood radius
+            metric: metric used as in scipy.spatial.distance.cdist
+            engine: 'tree', 'brute' or 'auto' (tree if the metric is supported)
+            dtype: type of the distance blocks of the brute force queries, see mcmm.clustering.DistanceKernel. The
+            neighborhoods are confirmed with float64 distances and do not depend on it. None (default) for float64.
+        '''
+        if engine == 'auto':
+            engine = 'tree' if metric in KDTREE_METRICS else 'brute'
+        if engine == 'tree' and metric not in KDTREE_METRICS:
+            raise InvalidValue('KD-tree neighborhood queries do not support the %s metric' % metric)
+        self._data = data
+        self._eps = eps
+        self._metric = metric
+        self._tree = cKDTree(data) if engine == 'tree' else None
+        self._kernel = DistanceKernel(data, metric, dtype) if engine == 'brute' else None
+
+    @property
+    def engine(self):
+        return 'brute' if self._tree is None else 'tree'
+
+    def __call__(self,indices):
+        '''
+        returns a list containing the sorted indices of the eps-neighborhood of each data point in indices
+        '''
+        if self._tree is None:
+            indices = np.asarray(indices, dtype=np.intp)
+            regions = []
+            for block in chunk_slices(len(indices), self._kernel.block_columns):
+                regions.extend(self._kernel.within(self._data[indices[block]], self._eps))
+            return regions
+        return tree_regions(self._tree, self._data, self._data[np.asarray(indices, dtype=np.intp)], self._eps,
+                            self._metric)
+
+
+class NeighborhoodGraph(object):
+    '''
+    Sparse eps-neighborhood graph of fixed data: entry (i,j) is stored iff the distance of points i and j is smaller
+    than eps (including i == j). Built once by region queries in blocks, it can be shared by DBSCAN fits with
+    different minPts.
+    '''
+
+    def __init__(self,data,eps,metric='euclidean',engine='auto',dtype=None):
+        '''
+        Args:
+            data: (n,d)-shaped ndarray
+            eps: neighborhood radius
+            metric: metric used as in scipy.spatial.distance.cdist
+            engine: engine of the RegionQuery used to build the graph
+            dtype: type of the distance blocks of the RegionQuery
+        '''
+        self._eps = eps
+        self._metric = metric
+        region_query = RegionQuery(data,eps,metric,engine,dtype)
+        n_samples = data.shape[0]
+        indices = []
+        degrees = np.empty(n_samples, dtype=np.intp)
+        for block in chunk_slices(n_samples, n_samples):
+            regions = region_query(np.arange(block.start, block.stop))
+            degrees[block] = [len(region) for region in regions]
+            indices.extend(regions)
+        indptr = np.concatenate([[0], np.cumsum(degrees)])
+        indices = np.concatenate(indices) if indices else np.empty(0, dtype=np.intp)
+        self._matrix = sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr),
+                                         shape=(n_samples, n_samples))
+        self._degrees = degrees
+
+    @property
+    def eps(self):
+        return self._eps
+
+    @property
+    def metric(self):
+        return self._metric
+
+    @property
+    def n_samples(self):
+        return self._matrix.shape[0]
+
+    @property
+    def matrix(self):
+        '''(n,n) scipy.sparse.csr_matrix of the graph'''
+        return self._matrix
+
+    @property
+    def degrees(self):
+        '''eps-neighborhood sizes of all points (including the point itself)'''
+        return self._degrees
 
 
 #------------
@@ -99,46 +354,242 @@ def get_region(data,p,eps,metric):
 
     return indices
 
-def expand_cluster(data,i,neighbor_indices,cluster_labels,active_cluster_index,eps,minPts,visited,metric):
+def tree_regions(tree,data,points,eps,metric='euclidean'):
+    '''
+    returns a list containing the sorted indices of the data points at distance < eps of each of the (m,d) points,
+    using a cKDTree over the data. query_ball_point includes the radius and decides on its own rounding, so it is
+    queried with a radius enlarged by a rounding margin and the candidates are confirmed with the distances of
+    mcmm.clustering.paired_distances, as the brute force queries.
     '''
+    candidates = tree.query_ball_point(points, eps*(1 + 1e-9), p=KDTREE_METRICS[metric], return_sorted=True)
+    counts = np.array([len(candidate) for candidate in candidates], dtype=np.intp)
+    if np.sum(counts) == 0:
+        return [np.empty(0, dtype=np.intp) for candidate in candidates]
+    others = np.fromiter(itertools.chain.from_iterable(candidates), dtype=np.intp, count=np.sum(counts))
+    queries = np.repeat(np.arange(len(candidates)), counts)
+    inside = paired_distances(points[queries], data[others], metric) < eps
+    return np.split(others[inside], np.cumsum(np.bincount(queries[inside], minlength=len(candidates)))[:-1])
 
+def expand_cluster(neighbor_indices,cluster_labels,active_cluster_index,minPts,visited,core,queue,region_query,
+                   batch_size=1024):
     '''
-    #label active point
-    cluster_labels[i] = active_cluster_index
-    neighbors = data[neighbor_indices]
+    grows the cluster of a core point from its neighborhood neighbor_indices. Unlabeled or noise points in the
+    neighborhood of a core point get the active cluster label, unvisited ones are queued. Queued points are visited
+    in batches of batch_size with one region_query call, and the neighborhoods of core points among them are
+    processed in turn until the queue is empty.
 
-    #walk through unvisited points in neighborhood
+    Args:
+        neighbor_indices: index array, neighborhood of the core point starting the cluster
+        cluster_labels: int array of labels, -1 for unlabeled or noise points. Updated in place.
+        active_cluster_index: label of the grown cluster
+        minPts: minimal neighborhood size of core points
+        visited, core: boolean arrays flagging queried points and core points. Updated in place.
+        queue: empty ClusterQueue
+        region_query: RegionQuery on the data
+    '''
+    neighbor_indices = np.asarray(neighbor_indices)
     while True:
-        counter = 0
-
-        #expand neighborhood until it does not grow anymore
-        while True:
-
-            k=neighbor_indices[counter]
-            if not visited[k]:
-                visited[k] = True
-                neighbor = data[k]
-                neighbor_indices2 = get_region(data,neighbor,eps,metric)
-                if len(neighbor_indices2) >= minPts:
-                    neighbor_indices = list(set(neighbor_indices)|set(neighbor_indices2))
-            if cluster_labels[k] is None:
-                cluster_labels[k] = active_cluster_index
-            counter = counter + 1
-            #break condition inner loop: counter bigger than nbhd size
-            if counter>=len(neighbor_indices):
-                break
-
-        #break condition outer loop: all points visited
-        if np.all(visited[neighbor_indices]):
+        cluster_labels[neighbor_indices[cluster_labels[neighbor_indices] == -1]] = active_cluster_index
+        queue.push(neighbor_indices[~visited[neighbor_indices]])
+        if len(queue) == 0:
             break
+        batch = queue.pop(batch_size)
+        visited[batch] = True
+        regions = region_query(batch)
+        batch_core = np.array([len(region) >= minPts for region in regions], dtype=bool)
+        core[batch[batch_core]] = True
+        core_regions = [region for region, is_core in zip(regions, batch_core) if is_core]
+        neighbor_indices = np.concatenate(core_regions) if core_regions else np.empty(0, dtype=np.intp)
+
+def graph_clusters(graph,minPts):
+    '''
+    DBSCAN clustering from a NeighborhoodGraph: core points are the points with degree >= minPts, clusters are the
+    connected components of the graph restricted to core points. Clusters are numbered by their first core point
+    and border points get the smallest label among their core neighbors, which reproduces the labels of the region
+    query expansion in DBSCAN.fit.
+
+    Returns:
+        cluster_labels: int32 array with -1 marking noise
+        core: boolean core point mask
+        n_clusters: number of clusters
+    '''
+    core = graph.degrees >= minPts
+    core_indices = np.flatnonzero(core)
+    cluster_labels = np.full(graph.n_samples, -1, dtype=np.int32)
+    if core_indices.size == 0:
+        return cluster_labels, core, 0
+    core_graph = graph.matrix[core_indices][:, core_indices]
+    n_clusters, components = connected_components(core_graph, directed=False)
+    # number the components by their first core point
+    first = np.full(n_clusters, graph.n_samples)
+    np.minimum.at(first, components, core_indices)
+    rank = np.empty(n_clusters, dtype=np.int32)
+    rank[np.argsort(first)] = np.arange(n_clusters)
+    cluster_labels[core_indices] = rank[components]
+
+    border_graph = graph.matrix[~core][:, core_indices].tocsr()
+    border_graph.sort_indices()
+    has_core = np.diff(border_graph.indptr) > 0
+    if np.any(has_core):
+        neighbor_labels = cluster_labels[core_indices][border_graph.indices]
+        starts = border_graph.indptr[:-1][has_core]
+        border_labels = np.minimum.reduceat(neighbor_labels, starts)
+        cluster_labels[np.flatnonzero(~core)[has_core]] = border_labels
+    return cluster_labels, core, n_clusters
+
+def grid_clusters(data,eps,minPts,batch_size=4096,n_representatives=4):
+    '''
+    Exact euclidean DBSCAN for low dimensional data on a grid of cells with side eps/sqrt(d), so that all points
+    of one cell are closer than eps to each other.
+
+    All points of cells containing at least minPts points are core points without any distance computation, the
+    points in the other cells by the distance to their minPts-th nearest neighbor in a KD-tree (with the exact
+    confirmation of tree_regions near eps). Cells with core points are merged as connected components of their
+    links: all neighboring cells are linked in bulk by the distances between n_representatives core points of both
+    cells, the adjacent ones first, so that the others are only tested if they are not connected yet. The remaining
+    cell pairs of different components are tested on all their core points in batches. All link distances are
+    computed in float64 in the order of mcmm.clustering.paired_distances, also for single precision data, so that
+    clusters and border points are labeled as in graph_clusters, i.e. exactly as DBSCAN.fit.
+
+    Args:
+        data: (n,d)-shaped ndarray with d <= 3
+        eps: neighborhood radius
+        minPts: minimal neighborhood size of core points
+        batch_size: number of cell pairs linked at once in the bulk pass, the batches of the exact pass compare about
+        batch_size*n_representatives**2 point pairs
+        n_representatives: number of core points per cell compared in the bulk pass
+
+    Returns:
+        cluster_labels, core, n_clusters: as graph_clusters
+    '''
+    n_samples, dim = data.shape
+    side = eps/np.sqrt(dim)
+    cells = np.floor(data/side).astype(np.int64)
+    cells -= np.min(cells, axis=0)
+    # exact mixed radix cell keys, padded by the maximal neighbor offset on both sides
+    reach = int(np.ceil(np.sqrt(dim)))
+    extent = np.max(cells, axis=0) + 2*reach + 1
+    if np.sum(np.log2(extent)) >= 62:
+        raise InvalidValue('Data extent too large for the grid engine, use a larger eps or another engine')
+    radix = np.concatenate([[1], np.cumprod(extent[:-1])])
+    point_keys = np.dot(cells + reach, radix)
+    order = np.argsort(point_keys, kind='stable')
+    cell_keys, cell_start, cell_count = np.unique(point_keys[order], return_index=True, return_counts=True)
+    point_cell = np.searchsorted(cell_keys, point_keys)
+
+    # neighbor cells are the cells with a minimal distance below eps
+    offsets = np.array([o for o in itertools.product(range(-reach, reach+1), repeat=dim)
+                        if np.sum(np.square(np.maximum(np.abs(o), 1) - 1)) < dim], dtype=np.int64)
+    offset_keys = np.dot(offsets, radix)
 
-    return cluster_labels,visited
+    def neighbor_cells(cell_ids):
+        # (len(cell_ids), len(offsets)) existing neighbor cell ids, -1 where the neighbor cell is empty
+        keys = cell_keys[cell_ids][:, np.newaxis] + offset_keys
+        found = np.minimum(np.searchsorted(cell_keys, keys), len(cell_keys) - 1)
+        return np.where(cell_keys[found] == keys, found, -1)
 
+    # core points, the points in sparse cells are core points if their minPts-th nearest neighbor (the point itself
+    # included) found by a tree over all points is closer than eps. The exact count (see tree_regions) is only
+    # determined for points whose neighbor lies within the rounding margin of eps
+    core = cell_count[point_cell] >= minPts
+    sparse_points = np.flatnonzero(~core)
+    queries = others = np.empty(0, dtype=np.intp)
+    if sparse_points.size:
+        tree = cKDTree(data)
+        kth_dist = tree.query(data[sparse_points], k=minPts, distance_upper_bound=eps*(1 + 1e-9))[0]
+        kth_dist = np.reshape(kth_dist, (sparse_points.size, -1))[:, -1]
+        degrees = np.where(kth_dist < eps*(1 - 1e-9), minPts, 0)
+        unsure = np.flatnonzero((kth_dist >= eps*(1 - 1e-9)) & np.isfinite(kth_dist))
+        if unsure.size:
+            regions = tree_regions(tree, data, data[sparse_points[unsure]], eps)
+            degrees[unsure] = [len(region) for region in regions]
+        core[sparse_points[degrees >= minPts]] = True
+        non_core = sparse_points[degrees < minPts]
+        if non_core.size:
+            neighborhoods = tree_regions(tree, data, data[non_core], eps)
+            queries = np.repeat(non_core, [len(neighbors) for neighbors in neighborhoods])
+            others = np.concatenate(neighborhoods)
 
+    cluster_labels = np.full(n_samples, -1, dtype=np.int32)
+    core_indices = np.flatnonzero(core)
+    if core_indices.size == 0:
+        return cluster_labels, core, 0
 
+    # merge core cells, first by a few representative core points per cell and then exactly for the cell pairs
+    # that are not connected yet
+    core_order = order[core[order]]
+    core_cells, core_start, core_count = np.unique(point_cell[core_order], return_index=True, return_counts=True)
+    n_core_cells = len(core_cells)
+    core_slot = np.full(len(cell_keys), -1)
+    core_slot[core_cells] = np.arange(n_core_cells)
+    neighbors = neighbor_cells(core_cells).ravel()
+    pair_a = np.repeat(np.arange(n_core_cells), len(offsets))
+    pair_b = np.where(neighbors >= 0, core_slot[neighbors], -1)
+    adjacent = np.tile(np.max(np.abs(offsets), axis=1) <= 1, n_core_cells)
+    forward = pair_b > pair_a
+    pair_a, pair_b, adjacent = pair_a[forward], pair_b[forward], adjacent[forward]
+    representatives = core_order[core_start[:, np.newaxis] +
+                                 np.arange(n_representatives) % core_count[:, np.newaxis]]
+    linked = np.zeros(len(pair_a), dtype=bool)
 
+    def cell_components():
+        cell_graph = sparse.coo_matrix((np.ones(np.sum(linked)), (pair_a[linked], pair_b[linked])),
+                                       shape=(n_core_cells, n_core_cells))
+        return connected_components(cell_graph, directed=False)[1]
 
+    def link_representatives(pairs):
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start+batch_size]
+            diff = np.subtract(data[representatives[pair_a[batch]]][:, :, np.newaxis],
+                               data[representatives[pair_b[batch]]][:, np.newaxis], dtype=np.float64)
+            linked[batch] = np.min(np.sqrt(np.sum(np.square(diff), axis=3)), axis=(1, 2)) < eps
 
+    # adjacent cells link most of the cells of a cluster, the other neighbor cells are only tested if they are not
+    # connected by these links
+    link_representatives(np.flatnonzero(adjacent))
+    cell_roots = cell_components()
+    link_representatives(np.flatnonzero(~adjacent & (cell_roots[pair_a] != cell_roots[pair_b])))
+    cell_roots = cell_components()
 
+    # the pairs still open are compared on all their core points in batches of about as many point pairs as a
+    # representative batch, skipping the pairs connected by the batches before
+    open_pairs = np.flatnonzero(~linked & (cell_roots[pair_a] != cell_roots[pair_b]))
+    point_pairs = np.cumsum(core_count[pair_a[open_pairs]]*core_count[pair_b[open_pairs]])
+    start = 0
+    while start < len(open_pairs):
+        done = point_pairs[start-1] if start > 0 else 0
+        stop = max(start + 1, np.searchsorted(point_pairs, done + batch_size*n_representatives**2, side='right'))
+        batch = open_pairs[start:stop]
+        start = stop
+        batch = batch[cell_roots[pair_a[batch]] != cell_roots[pair_b[batch]]]
+        if batch.size == 0:
+            continue
+        count_a, count_b = core_count[pair_a[batch]], core_count[pair_b[batch]]
+        sizes = count_a*count_b
+        pair_index = np.repeat(np.arange(batch.size), sizes)
+        position = np.arange(np.sum(sizes)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        points_a = core_order[core_start[pair_a[batch]][pair_index] + position // count_b[pair_index]]
+        points_b = core_order[core_start[pair_b[batch]][pair_index] + position % count_b[pair_index]]
+        close = paired_distances(data[points_a], data[points_b]) < eps
+        linked[batch[np.unique(pair_index[close])]] = True
+        cell_roots = cell_components()
 
+    # number the clusters by their first core point
+    roots = cell_roots[core_slot[point_cell[core_indices]]]
+    unique_roots, components = np.unique(roots, return_inverse=True)
+    components = components.ravel()
+    n_clusters = len(unique_roots)
+    first = np.full(n_clusters, n_samples)
+    np.minimum.at(first, components, core_indices)
+    rank = np.empty(n_clusters, dtype=np.int32)
+    rank[np.argsort(first)] = np.arange(n_clusters)
+    cluster_labels[core_indices] = rank[components]
 
+    # border points get the smallest label among their core neighbors
+    to_core = core[others]
+    queries, others = queries[to_core], others[to_core]
+    border_labels = np.full(n_samples, np.iinfo(np.int32).max, dtype=np.int32)
+    np.minimum.at(border_labels, queries, cluster_labels[others])
+    border = np.flatnonzero(border_labels < np.iinfo(np.int32).max)
+    cluster_labels[border] = border_labels[border]
+    return cluster_labels, core, n_clusters
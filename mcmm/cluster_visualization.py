@@ -81,36 +81,47 @@ class ClusterViz(object):
             raise ValueError('Not able to plot with given feature_indices')
         plt.show()
 
-    def elbow(self,n_clusters):
+    def elbow(self,n_clusters,warm_start=True,n_jobs=1,plot=True):
         '''
         Implemetation of the elbow-rule plot (within cluster SSE vs. number of clusters), which is especially useful
         for KMeans fitting evaluation for shorter fitting times and/or smaller k
         Args:
             n_clusters: list of integers specifying the number of clusters
-
-        NOTE: the used cluster instance has to support the parameter 'k' in its .fit method. Using KMeans will work,
-        using for example Regspace will not for obvious reasons.
+            warm_start: start each fit from the centers of the fit with the next smaller k, see KMeans.sse_curve
+            n_jobs: number of processes for independent fits (warm_start=False), None for all cpus
+            plot: show the plot
+        Returns:
+            list of the within-cluster SSE for each k in n_clusters
+
+        NOTE: warm_start and n_jobs are passed to .sse_curve of the cluster instance (KMeans, MiniBatchKMeans),
+        which raises InvalidValue for settings it does not support. Instances without .sse_curve (e.g.
+        BisectingKMeans) are refitted for every k, which requires n_jobs=1 and support for the parameter 'k' in
+        their .fit method. Using for example Regspace will not work for obvious reasons.
         '''
-
-        SSE_list = []
-        for k in n_clusters:
-            try:
-                self._cluster_object.fit(k,verbose=False)
-            except:
-                ValueError('clustering instance must support number of cluster centers as parameter')
-            if type(self._cluster_object.cluster_dist) is list:
-                cluster_dist = np.concatenate(self._cluster_object.cluster_dist,axis=0)
-            else:
+        if hasattr(self._cluster_object,'sse_curve'):
+            SSE_list = self._cluster_object.sse_curve(n_clusters,warm_start=warm_start,n_jobs=n_jobs)
+        else:
+            if n_jobs != 1:
+                raise cl.InvalidValue('n_jobs requires a clustering instance providing .sse_curve')
+            SSE_list = []
+            for k in n_clusters:
+                try:
+                    self._cluster_object.fit(k,verbose=False)
+                except TypeError:
+                    raise ValueError('clustering instance must support number of cluster centers as parameter')
                 cluster_dist = self._cluster_object.cluster_dist
-            SSE = np.sum(np.square(cluster_dist))
-            SSE_list.append(SSE)
-
-        fig = plt.figure()
-        plt.plot(n_clusters,SSE_list)
-        plt.suptitle('within-cluster SSE vs. k')
-        plt.xlabel('$k$')
-        plt.ylabel('$SSE$')
-        plt.show()
+                if type(cluster_dist) is not list:
+                    cluster_dist = [cluster_dist]
+                SSE_list.append(cl.distance_summary(cluster_dist)['sse'])
+
+        if plot:
+            fig = plt.figure()
+            plt.plot(n_clusters,SSE_list)
+            plt.suptitle('within-cluster SSE vs. k')
+            plt.xlabel('$k$')
+            plt.ylabel('$SSE$')
+            plt.show()
+        return SSE_list
 
 #-------------------------------
 # cluster test visualizations
@@ -177,8 +188,5 @@ def DBSCAN_cirles(n_samples=10000,factor=.4,noise=.1,eps=.1,minPts=30):
     circle = circle[0]
     circlescan = DBSCAN.DBSCAN(circle,eps,minPts)
     #reassign noise for plotting
-    labels = circlescan.cluster_labels
-    for p, i in enumerate(labels):
-        if i == 'noise':
-            labels[p] = circlescan._n_clusters + 1
-    plt.scatter(circle[:, 0], circle[:, 1], c=circlescan.cluster_labels)
+    labels = np.where(circlescan.cluster_labels == -1, circlescan.n_clusters, circlescan.cluster_labels)
+    plt.scatter(circle[:, 0], circle[:, 1], c=labels)
@@ -4,52 +4,53 @@ This module should handle the discretization by means of a kmeans or regspace cl
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 __metaclass__ = type
-from random import sample
+import os
+import json
+import itertools
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
 import numpy as np
-from scipy.spatial import distance
-from scipy.stats import rv_discrete
+from numpy.lib.format import open_memmap
+from scipy.spatial import distance, cKDTree
 from timeit import default_timer as timer
-from datetime import timedelta
+from .common import *
+from .instrumentation import Instrumented
+
+#: default memory budget in bytes for the distance blocks computed by get_cluster_info
+CHUNK_MEMORY = 2**28
+
+#: scipy.spatial.distance metrics supported by cKDTree nearest neighbor queries and their Minkowski p
+KDTREE_METRICS = {'euclidean': 2, 'cityblock': 1, 'chebyshev': np.inf}
+
+#: maximal dimension for which nearest center lookups use a KD-tree instead of brute force distances
+KDTREE_MAX_DIM = 10
+
+#: maximal dimension supported by GridIndex, whose queries inspect 3^d neighboring cells
+GRID_MAX_DIM = 4
 
 #----------------
-#K-Means clustering
+#common base class
 #----------------
 
-class KMeans(object):
-    '''
-    Class providing simple k-Means clustering for (n,d)-shaped trajectory ndarray objects containing float data
-    or list of trajectory ndarrays each with fitting second dimension d
+class ClusteringBase(Instrumented):
     '''
+    Base class of the center based clustering classes. Provides the fitted properties, the preparation of list
+    data and the storage of labels and distances matching the initial data list.
 
-    def __init__(self,data,k,max_iter=150,method="forgy",metric='euclidean',atol=1e-03,rtol=1e-03,verbose=True):
-        '''
-        Args:
-            data: (n,d)-shaped 2-dimensional ndarray objects containing float data or a list consisting of
-            fitting ndarrays
-            k: int, number of cluster centers. required to be <= n.
-            max_iter: int, maximal iterations before terminating
-            method: way of initializing cluster centers. Use 'forgy' for Forgys method or 'kmeans++'
-            metric: metric used to compute distances. for possible arguments see metric arguments of scipy.spatial.distance.cdist
-            atol,rtol: absolute and relative tolerance threshold to stop iteration before reaching max_iter. see numpy.allclose documentation
-        '''
-        self._k = k
-        self._max_iter = max_iter
-        self._data = data
-        self._method = method
-        self._metric = metric
-        self._rtol = rtol
-        self._atol = atol
-        self._cluster_centers = None
-        self._cluster_labels = None
-        self._cluster_dist = None
-        self._traj_list_indices = None
-        self._verbose = verbose
-        self._fitted = False
-        self._data_type_list = None
+    Lists of trajectories containing .npy file paths or numpy.memmap arrays are not concatenated but streamed
+    in blocks of CHUNK_MEMORY bytes (out-of-core mode).
 
-        if self._metric != 'euclidean':
-            print('Initialized with %s metric. Use euclidean metric for classic KMeans. \n'
-                  'Bad things might happen, depending on your dataset and used metric.'%metric)
+    With dtype numpy.float32 data, cluster centers and distance blocks are kept in single precision, see
+    pairwise_distances. The default dtype None keeps the data as given and computes distances in float64.
+
+    Fits report iterations and phases to the attached listeners, see instrumentation.Instrumented.
+
+    Fitted models are stored by save and restored by load without their training data.
+
+    With stride > 1 or subsample the centers are fitted on every stride-th frame of each trajectory or a random
+    subset of the frames, which are then all assigned to the centers block by block.
+    '''
 
     @property
     def cluster_centers(self):
@@ -86,12 +87,318 @@ class KMeans(object):
     def data(self):
         return self._data
 
+    def _prepare_data(self):
+        '''
+        concatenates list data on the first fit and remembers the trajectory boundaries. In out-of-core mode
+        the trajectories are only opened as memory maps.
+        '''
+        if self._data is None:
+            raise InvalidOperation('No data to fit, the clustering was loaded without training data')
+        if self._data_type_list is None:
+            self._data_type_list = type(self._data) is list
+            if self._out_of_core is None:
+                self._out_of_core = is_out_of_core(self._data)
+        if self._data_type_list and not self._fitted:
+            if self._out_of_core:
+                self._data = open_trajectories(self._data)
+                self._traj_list_indices = np.cumsum([traj.shape[0] for traj in self._data])
+            else:
+                self._data, self._traj_list_indices = concat_list(self._data)
+        if self._dtype is not None and not self._out_of_core:
+            self._data = np.asarray(self._data, dtype=self._dtype)
+
+    def _fit_indices(self,random_state=None):
+        '''
+        returns the indices of the frames selected by stride and subsample (see subsample_indices), None if all
+        frames are used
+        '''
+        if self._stride == 1 and self._subsample is None:
+            return None
+        traj_lengths = np.diff(self._traj_list_indices, prepend=0) if self._data_type_list else [self._n_samples()]
+        return subsample_indices(traj_lengths, self._stride, self._subsample, random_state)
 
-    def fit(self,k=None,verbose=None):
+    def _fit_data(self,random_state=None,indices=None):
+        '''
+        returns the data the centers are fitted on: the prepared data, or the frames selected by stride and
+        subsample as an in-memory array. Selected indices can be passed, see _fit_indices.
+        '''
+        if indices is None:
+            indices = self._fit_indices(random_state)
+        return self._data if indices is None else self._frames(indices)
+
+    def _n_samples(self):
+        if self._out_of_core:
+            return int(self._traj_list_indices[-1])
+        return self._data.shape[0]
+
+    def _frames(self,indices):
+        '''
+        returns the observations with given sorted indices into the (concatenated) data
+        '''
+        if self._out_of_core:
+            return np.asarray(take_frames(self._data, indices), dtype=self._dtype)
+        return self._data[indices]
+
+    def _set_results(self,cluster_centers,assignment=None):
+        '''
+        assigns the data to the final cluster centers and stores centers, labels and distances, the latter
+        split into lists if the object was initialized with a list of trajectories. Labels and distances of all
+        data computed before (e.g. by the final kmeans_restart) can be passed as assignment to skip the assignment.
+        '''
+        self._cluster_centers = cluster_centers
+        if assignment is not None:
+            cluster_labels, cluster_dist = assignment
+        elif self._out_of_core:
+            cluster_labels, cluster_dist = assign_trajectories(self._data, cluster_centers, self._metric,
+                                                               self._output_dir, assign=self._assign,
+                                                               dtype=self._dtype)
+        else:
+            cluster_labels, cluster_dist = self._assign(self._data)
+        #cutting of labels according to given list
+        if self._data_type_list and not self._out_of_core:
+            cluster_labels=np.split(cluster_labels,self._traj_list_indices[:-1])
+            cluster_dist = np.split(cluster_dist,self._traj_list_indices[:-1])
+        self._cluster_labels = cluster_labels
+        self._cluster_dist = cluster_dist
+        self._fitted = True
+
+    def _assign(self,data):
+        '''
+        returns labels and distances of an (n,d) ndarray with respect to the stored cluster centers
+        '''
+        return get_cluster_info(data, self._cluster_centers, metric=self._metric, dtype=self._dtype)
+
+    def transform(self,data,n_threads=1):
+        '''
+        Returns cluster labeling for additional data corresponding
+        to existing cluster centers stored in the object. (Also fits to initial data, if not fitted before)
+        Args:
+            data: (n,d)-shaped ndarray or list consisting of ndarrays each with matching second dimension d,
+            numpy.memmap arrays or paths to .npy files
+            n_threads: int, number of threads the blocks of data are assigned on, None for all cpus. The distance
+            computations release the GIL, results are the same as with a single thread.
+        Returns:
+            cluster labels for passed data argument and cluster distances with respect to the given metric
+        '''
+        if not self._fitted:
+            self.fit()
+
+        if type(data) is list:
+            return assign_trajectories(open_trajectories(data), self.cluster_centers, self._metric, assign=self._assign,
+                                       dtype=self._dtype, n_threads=n_threads)
+        if n_threads != 1:
+            cluster_labels, cluster_dist = assign_trajectories([data], self.cluster_centers, self._metric,
+                                                               assign=self._assign, dtype=self._dtype,
+                                                               n_threads=n_threads)
+            return cluster_labels[0], cluster_dist[0]
+        return self._assign(np.asarray(data, dtype=self._dtype))
+
+    def transform_iter(self,chunks,n_threads=1):
+        '''
+        Streaming variant of transform for data that does not fit into memory: assigns an iterable of (m,d)-shaped
+        frame blocks, e.g. from iter_trajectory_chunks, one at a time and yields the cluster labels and distances of
+        each block. (Also fits to initial data, if not fitted before)
+        Args:
+            chunks: iterable of (m,d)-shaped ndarrays
+            n_threads: number of threads each block is assigned on, see transform
+        '''
+        if not self._fitted:
+            self.fit()
+        for chunk in chunks:
+            yield self.transform(np.asarray(chunk), n_threads=n_threads)
+
+    def save(self,path,labels=False):
+        '''
+        Stores the fitted model to a .npz file containing the cluster centers, the metric and the constructor
+        parameters, but not the training data. (Also fits to initial data, if not fitted before)
+        Args:
+            path: file name of the .npz file, the extension is appended if missing
+            labels: if True, the cluster labels and distances of the training data are also written, one pair of
+            .npy files <path>_labels_<i>.npy and <path>_dist_<i>.npy per trajectory, which load memory maps
+        '''
+        if not self._fitted:
+            self.fit()
+        if not path.endswith('.npz'):
+            path += '.npz'
+        n_label_files = 0
+        if labels:
+            labels_list, dist_list = self._cluster_labels, self._cluster_dist
+            if not self._data_type_list:
+                labels_list, dist_list = [labels_list], [dist_list]
+            for i, (cluster_labels, cluster_dist) in enumerate(zip(labels_list, dist_list)):
+                np.save(_label_file(path, 'labels', i), cluster_labels)
+                np.save(_label_file(path, 'dist', i), cluster_dist)
+            n_label_files = len(labels_list)
+        np.savez(path, cluster_centers=self._cluster_centers, estimator=type(self).__name__,
+                 params=json.dumps(self._params()), list_labels=bool(self._data_type_list),
+                 n_label_files=n_label_files, **self._model_arrays())
+
+    @classmethod
+    def load(cls,path,mmap_mode='r',verbose=False):
+        '''
+        Restores a model stored by save, e.g. for assigning new data by transform. The model has no training data,
+        so it cannot be refitted, and cluster_labels and cluster_dist are only available if they were saved.
+        Calling load on ClusteringBase restores any clustering class.
+        Args:
+            path: .npz file written by save
+            mmap_mode: mode in which the saved labels and distances are memory mapped, see numpy.load. None reads
+            them into memory.
+            verbose: verbose setting of the restored model
+        '''
+        with np.load(path) as stored:
+            estimator = str(stored['estimator'])
+            classes = dict((subclass.__name__, subclass) for subclass in _subclasses(ClusteringBase))
+            if estimator not in classes or not issubclass(classes[estimator], cls):
+                raise InvalidValue('%s does not contain a %s model' % (path, cls.__name__))
+            clustering = classes[estimator](None, verbose=verbose, **json.loads(str(stored['params'])))
+            clustering._restore(stored)
+            list_labels = bool(stored['list_labels'])
+            n_label_files = int(stored['n_label_files'])
+        if n_label_files > 0:
+            labels_list = [np.load(_label_file(path, 'labels', i), mmap_mode=mmap_mode) for i in range(n_label_files)]
+            dist_list = [np.load(_label_file(path, 'dist', i), mmap_mode=mmap_mode) for i in range(n_label_files)]
+            clustering._traj_list_indices = np.cumsum([len(cluster_labels) for cluster_labels in labels_list])
+            if list_labels:
+                clustering._cluster_labels, clustering._cluster_dist = labels_list, dist_list
+            else:
+                clustering._cluster_labels, clustering._cluster_dist = labels_list[0], dist_list[0]
+        clustering._data_type_list = list_labels
+        return clustering
+
+    def _params(self):
+        '''
+        returns the constructor parameters stored by save as a dict of JSON serializable values
+        '''
+        return dict(metric=self._metric, dtype=None if self._dtype is None else np.dtype(self._dtype).name,
+                    stride=self._stride, subsample=self._subsample)
+
+    def _model_arrays(self):
+        '''
+        returns a dict of further arrays describing the fitted model, which save stores besides the cluster centers
+        '''
+        return {}
+
+    def _restore(self,stored):
+        '''
+        sets the state of a fitted model without data from the arrays stored by save, see load
+        '''
+        self._cluster_centers = stored['cluster_centers']
+        self._fitted = True
+
+    def _distance_summary(self,sample_weight=None):
+        '''
+        returns the maximal and mean distance to the centers and the within-cluster SSE of the fit as record fields,
+        the latter two weighted by optional sample weights, see distance_summary
+        '''
+        return distance_summary(self._cluster_dist if self._data_type_list else [self._cluster_dist], sample_weight)
+
+#----------------
+#K-Means clustering
+#----------------
+
+class KMeans(ClusteringBase):
+    '''
+    Class providing simple k-Means clustering for (n,d)-shaped trajectory ndarray objects containing float data
+    or list of trajectory ndarrays each with fitting second dimension d
+    '''
+
+    def __init__(self,data,k,max_iter=150,method="forgy",metric='euclidean',atol=1e-03,rtol=1e-03,verbose=True,
+                 algorithm='lloyd',n_init=1,n_jobs=1,random_state=None,out_of_core=None,output_dir=None,dtype=None,
+                 listeners=None,stride=1,subsample=None):
+        '''
+        Args:
+            data: (n,d)-shaped 2-dimensional ndarray objects containing float data or a list consisting of
+            fitting ndarrays, numpy.memmap arrays or paths to .npy files
+            k: int, number of cluster centers. required to be <= n.
+            max_iter: int, maximal iterations before terminating
+            method: way of initializing cluster centers. Use 'forgy' for Forgys method, 'kmeans++' or its
+            oversampling variant 'kmeans||'
+            metric: metric used to compute distances. for possible arguments see metric arguments of scipy.spatial.distance.cdist
+            atol,rtol: absolute and relative tolerance threshold to stop iteration before reaching max_iter. see numpy.allclose documentation
+            algorithm: 'lloyd' for plain Lloyd iterations or 'hamerly' for Lloyd iterations accelerated by
+            triangle-inequality distance bounds (euclidean metric only). Both yield the same result.
+            n_init: int, number of independently initialized runs. The run with the lowest within-cluster sum of
+            squared errors is kept.
+            n_jobs: int, number of worker processes the runs are distributed to. None uses all available cpus.
+            n_jobs != 1 requires Python >= 3.8.
+            random_state: None, int seed or numpy.random.Generator used for the center initialization
+            out_of_core: stream list data in blocks instead of concatenating it. None enables streaming if the
+            list contains file paths or numpy.memmap arrays. Out-of-core fits run the lloyd algorithm serially and
+            initialize centers on a random subsample of the data.
+            output_dir: directory to write out-of-core labels and distances to as labels_<i>.npy and dist_<i>.npy,
+            which are then returned as numpy.memmap arrays. None keeps them in memory.
+            dtype: numpy.float32 keeps data, cluster centers and distances in single precision, cluster sums are
+            accumulated in float64. None (default) keeps the data type of the data and computes in float64.
+            listeners: list of callables receiving the fit records, e.g. an instrumentation.EventCollector.
+            verbose=True prints the summary record of each fit. Runs on worker processes (n_jobs) only report
+            their restart records.
+            stride: int, fit the centers on every stride-th frame of each trajectory only
+            subsample: int number or float fraction of the (strided) frames drawn at random (using random_state)
+            to fit the centers on. With stride or subsample all frames are assigned to the fitted centers
+            afterwards, the runs of out-of-core data are then performed in memory on the selected frames.
+        '''
+        if algorithm not in ('lloyd', 'hamerly'):
+            raise InvalidValue('Unknown KMeans algorithm %s' % algorithm)
+        if algorithm == 'hamerly' and metric != 'euclidean':
+            raise InvalidValue('The hamerly algorithm requires the euclidean metric')
+        self._k = k
+        self._algorithm = algorithm
+        self._n_init = n_init
+        self._n_jobs = n_jobs
+        self._random_state = random_state
+        self._restart_times = None
+        self._restart_sse = None
+        self._max_iter = max_iter
+        self._data = data
+        self._method = method
+        self._metric = metric
+        self._rtol = rtol
+        self._atol = atol
+        self._cluster_centers = None
+        self._cluster_labels = None
+        self._cluster_dist = None
+        self._traj_list_indices = None
+        self._verbose = verbose
+        self._fitted = False
+        self._data_type_list = None
+        self._out_of_core = out_of_core
+        self._output_dir = output_dir
+        self._dtype = dtype
+        self._listeners = [] if listeners is None else list(listeners)
+        self._stride = stride
+        self._subsample = subsample
+
+        if self._metric != 'euclidean':
+            print('Initialized with %s metric. Use euclidean metric for classic KMeans. \n'
+                  'Bad things might happen, depending on your dataset and used metric.'%metric)
+
+    def _params(self):
+        params = super(KMeans,self)._params()
+        params.update(k=self._k, max_iter=self._max_iter, method=self._method, atol=self._atol, rtol=self._rtol,
+                      algorithm=self._algorithm, n_init=self._n_init)
+        if isinstance(self._random_state, (int, np.integer)):
+            params.update(random_state=int(self._random_state))
+        return params
+
+    @property
+    def restart_times(self):
+        '''wall times in seconds of the individual runs of the last fit'''
+        return self._restart_times
+
+    @property
+    def restart_sse(self):
+        '''within-cluster sums of squared errors of the individual runs of the last fit'''
+        return self._restart_sse
+
+
+    def fit(self,k=None,verbose=None,init_centers=None,sample_weight=None):
         '''
         Runs the clustering iteration on the data it was given when initialized. If the object is not fitted,
         accessing .cluster_labels, .cluster_centers and .cluster_dist will also lead to a call of .fit().
 
+        Passing a (k,d)-shaped array of init_centers starts the iteration from these centers instead of an
+        initialization by method (warm start). k is then taken from init_centers and a single run is performed.
+
         You can specify k and verbose parameters ether in the .fit method or when initializing the KMeans instance.s
 
         Cluster centers,cluster labels and distances to associated center for the given data will
@@ -101,25 +408,235 @@ class KMeans(object):
         NOTE: multiple calls of .fit() are possible and will yield different outcomes, since KMeans
         always has a random component due to its cluster initialization. Just accessing the properties
         .cluster_labels, .cluster_centers and .cluster_dist will however NOT change the stored properties.
+        With n_init > 1 the best of several runs is kept, their timings and SSEs are stored in .restart_times
+        and .restart_sse. With stride or subsample these are the SSEs of the selected frames.
+
+        sample_weight: (n,)-shaped array (or list matching the data list) of non-negative weights of the
+        observations, e.g. the counts of unique_frames. The initialization draws observations with probabilities
+        proportional to their weights (times D^2 for kmeans++), centers are weighted means and the SSEs are
+        weighted, so a weight w acts like w copies of the observation. Unless init_centers are given, at least k
+        observations need a positive weight. Not supported for streamed out-of-core fits.
         '''
         if k is not None:
             self._k = k
         if verbose is not None:
             self._verbose = verbose
-        if self._verbose:
-            start_time = timer()
-        if self._data_type_list is None:
-            self._data_type_list = type(self._data) is list
-        if self._data_type_list and not self._fitted:
-            self._data, self._traj_list_indices = concat_list(self._data)
-        cluster_centers = initialize_centers(self._data, self._k, self._method)
+        callback = self._callback()
+        start_time = timer()
+        self._prepare_data()
+        random_state = check_random_state(self._random_state)
+        indices = self._fit_indices(random_state)
+        fit_data = self._fit_data(indices=indices)
+        streamed = type(fit_data) is list
+        if streamed and self._algorithm != 'lloyd':
+            raise InvalidValue('Out-of-core KMeans only supports the lloyd algorithm')
+        fit_weight = None
+        if sample_weight is not None:
+            if type(sample_weight) is list:
+                sample_weight = np.concatenate(sample_weight)
+            sample_weight = np.asarray(sample_weight, dtype=np.float64)
+            if sample_weight.shape != (self._n_samples(),) or np.any(sample_weight < 0):
+                raise InvalidValue('sample_weight has to contain one non-negative weight per observation')
+            fit_weight = sample_weight if indices is None else sample_weight[indices]
+        if init_centers is not None:
+            init_centers = np.asarray(init_centers)
+            if k is not None and k != init_centers.shape[0]:
+                raise InvalidValue('k does not match the number of initial centers')
+            self._k = init_centers.shape[0]
+        elif fit_weight is not None and np.count_nonzero(fit_weight) < self._k:
+            raise InvalidValue('sample_weight has to be positive for at least k observations')
+        settings = (self._k, self._method, self._algorithm, self._max_iter, self._metric, self._atol, self._rtol)
+        if callback is not None and fit_data is not self._data:
+            callback('phase', phase='subsampling', wall_time=timer() - start_time, n_samples=fit_data.shape[0])
+        #the final assignment of a run on all frames is kept for the results, streamed runs only write it if they
+        #cannot be overwritten by a later run
+        n_runs = 1 if init_centers is not None else self._n_init
+        keep_assignment = indices is None and (not streamed or n_runs == 1)
+        assignment = None
+        if n_runs > 1 and self._n_jobs != 1 and not streamed:
+            restarts = parallel_restarts(fit_data, settings, self._n_init, self._n_jobs, random_state, self._dtype,
+                                         fit_weight)
+        else:
+            restarts = []
+            for i in range(n_runs):
+                restart = kmeans_restart(fit_data, *settings, random_state=random_state, dtype=self._dtype,
+                                         init_centers=init_centers, callback=callback, sample_weight=fit_weight,
+                                         assignment=keep_assignment, output_dir=self._output_dir)
+                if keep_assignment:
+                    if not restarts or restart[3] < min(run[3] for run in restarts):
+                        assignment = restart[5]
+                    restart = restart[:5]
+                restarts.append(restart)
+        self._restart_sse = [restart[3] for restart in restarts]
+        self._restart_times = [restart[4] for restart in restarts]
+        cluster_centers, counter, break_cond = restarts[int(np.argmin(self._restart_sse))][:3]
+        if callback is not None:
+            for i, restart in enumerate(restarts):
+                callback('restart', restart=i, iterations=restart[1], converged=restart[2], sse=restart[3],
+                         wall_time=restart[4])
+            assignment_start = timer()
+
+        self._set_results(cluster_centers, assignment)
+        if callback is not None:
+            callback('phase', phase='assignment', wall_time=timer() - assignment_start)
+            callback('fit', wall_time=timer() - start_time, iterations=counter, converged=break_cond,
+                     n_clusters=self._k, **self._distance_summary(sample_weight))
+
+    def sse_curve(self,n_clusters,warm_start=True,n_jobs=1):
+        '''
+        Fits the data for every number of clusters in n_clusters and returns the within-cluster sums of squared
+        errors, e.g. for the elbow rule (see cluster_visualization.ClusterViz.elbow). The object keeps the fit with
+        the largest k and its verbose setting. With stride or subsample the SSEs are still those of all frames.
+
+        With warm_start the k values are fitted in increasing order: the smallest one as configured, each further
+        one starting from the centers of the previous fit plus new centers drawn by kmeans++ D^2 weighting (on a
+        subsample for out-of-core data). Otherwise the k values are fitted independently with n_init runs each, on
+        n_jobs processes (None for all cpus) if n_jobs != 1. With warm_start, n_jobs != 1 runs the n_init restarts
+        of the first fit in parallel instead of n_jobs of the object, the later fits start from given centers and
+        run once.
+
+        Args:
+            n_clusters: list of integers specifying the numbers of clusters
+            warm_start: bool, reuse the previous fit for the next k
+            n_jobs: int, number of processes for the fits of in-memory data
+        Returns:
+            list of the within-cluster SSE for each k in n_clusters
+        '''
+        order = np.argsort(n_clusters, kind='stable')
+        sse = np.empty(len(n_clusters))
+        self._prepare_data()
+        if not warm_start and n_jobs != 1 and not self._out_of_core:
+            random_state = check_random_state(self._random_state)
+            indices = self._fit_indices(random_state)
+            settings_list = [(n_clusters[i], self._method, self._algorithm, self._max_iter, self._metric, self._atol,
+                              self._rtol) for i in order for run in range(self._n_init)]
+            restarts = parallel_kmeans(self._fit_data(indices=indices), settings_list, n_jobs, random_state,
+                                       self._dtype)
+            for position, i in enumerate(order):
+                runs = restarts[position*self._n_init:(position+1)*self._n_init]
+                best = int(np.argmin([run[3] for run in runs]))
+                if indices is None:
+                    sse[i] = runs[best][3]
+                else:
+                    #the runs are scored on the selected frames, the curve on all frames as in the serial fits
+                    sse[i] = weighted_sse(get_cluster_info(self._data, runs[best][0], metric=self._metric,
+                                                           dtype=self._dtype)[1])
+            self._k = n_clusters[order[-1]]
+            self._restart_sse = [run[3] for run in runs]
+            self._restart_times = [run[4] for run in runs]
+            self._set_results(runs[best][0])
+            return list(sse)
+
+        random_state = check_random_state(self._random_state)
+        verbose, fit_jobs = self._verbose, self._n_jobs
+        if n_jobs != 1:
+            self._n_jobs = n_jobs
+        try:
+            for position, i in enumerate(order):
+                if not warm_start or position == 0:
+                    self.fit(n_clusters[i], verbose=False)
+                else:
+                    previous = self._cluster_centers
+                    if self._out_of_core:
+                        n_samples = self._n_samples()
+                        init_size = min(n_samples, max(100*n_clusters[i], 10000))
+                        seed_data = self._frames(np.sort(random_state.choice(n_samples, init_size, replace=False)))
+                    else:
+                        seed_data = self._data
+                    init_centers = kmeans_plusplus_centers(seed_data, n_clusters[i], random_state,
+                                                           init_centers=previous)
+                    self.fit(verbose=False, init_centers=init_centers)
+                sse[i] = distance_summary(self._cluster_dist if self._data_type_list else [self._cluster_dist])['sse']
+        finally:
+            self._verbose, self._n_jobs = verbose, fit_jobs
+        return list(sse)
+
+
+class MiniBatchKMeans(KMeans):
+    '''
+    Mini-batch variant of KMeans for very large trajectory sets. Cluster centers are updated from randomly
+    drawn batches of observations with per-center learning rates, the full data set is only assigned once
+    to the final centers.
+    '''
+
+    def __init__(self,data,k,batch_size=1000,max_iter=150,method="forgy",metric='euclidean',atol=1e-03,rtol=1e-03,
+                 verbose=True,random_state=None,dtype=None,listeners=None):
+        '''
+        Args:
+            data: (n,d)-shaped 2-dimensional ndarray objects containing float data or a list consisting of
+            fitting ndarrays
+            k: int, number of cluster centers. required to be <= n.
+            batch_size: int, number of observations drawn (with replacement) for each center update
+            max_iter: int, maximal number of batches before terminating
+            method: way of initializing cluster centers. Use 'forgy' for Forgys method or 'kmeans++'. The
+            initialization is run on a random subset of 3*batch_size observations.
+            metric: metric used to compute distances. for possible arguments see metric arguments of scipy.spatial.distance.cdist
+            atol,rtol: absolute and relative tolerance threshold to stop iteration before reaching max_iter. see numpy.allclose documentation
+            random_state: None, int seed or numpy.random.Generator used for initialization and batch sampling
+            dtype: floating point precision, see KMeans
+            listeners: list of callables receiving the fit records, see KMeans. The iteration records report the SSE
+            of the batches.
+        '''
+        super(MiniBatchKMeans,self).__init__(data,k,max_iter=max_iter,method=method,metric=metric,atol=atol,rtol=rtol,
+                                             verbose=verbose,random_state=random_state,dtype=dtype,listeners=listeners)
+        self._batch_size = batch_size
+
+    def _params(self):
+        params = super(MiniBatchKMeans,self)._params()
+        del params['algorithm'], params['n_init'], params['stride'], params['subsample']
+        params.update(batch_size=self._batch_size)
+        return params
+
+    def fit(self,k=None,verbose=None,init_centers=None):
+        '''
+        Runs the mini-batch clustering iteration on the data it was given when initialized, followed by one
+        assignment of all observations to the resulting centers. Labels and distances of list data are returned in
+        lists as in KMeans.fit, init_centers start the iteration from given centers as in KMeans.fit.
+
+        Each center keeps the number of observations assigned to it so far. A batch moves every center towards the
+        mean of its assigned batch observations with a learning rate of (assigned in batch)/(assigned so far).
+        '''
+        if k is not None:
+            self._k = k
+        if verbose is not None:
+            self._verbose = verbose
+        callback = self._callback()
+        start_time = timer()
+        self._prepare_data()
+        n_samples = self._n_samples()
+        batch_size = min(self._batch_size, n_samples)
+
+        random_state = check_random_state(self._random_state)
+        if init_centers is None:
+            init_size = min(max(3*batch_size, self._k), n_samples)
+            init_data = self._frames(np.sort(random_state.choice(n_samples, init_size, replace=False)))
+            init_centers = initialize_centers(init_data, self._k, self._method, random_state)
+        elif k is not None and k != len(init_centers):
+            raise InvalidValue('k does not match the number of initial centers')
+        self._k = len(init_centers)
+        cluster_centers = np.array(init_centers, dtype=float if self._dtype is None else self._dtype)
+        center_counts = np.zeros(self._k)
+        if callback is not None:
+            callback('phase', phase='initialization', wall_time=timer() - start_time)
+            iteration_start = timer()
 
         counter = 0
         break_cond = False # flags the termination by break condition
 
         while counter < self._max_iter:
-            cluster_labels, cluster_dist = get_cluster_info(self._data, cluster_centers, metric=self._metric)
-            new_cluster_centers = set_new_cluster_centers(self._data, cluster_labels, self._k)
+            if callback is not None:
+                batch_start = timer()
+            batch = self._frames(np.sort(random_state.integers(0, n_samples, batch_size)))
+            batch_labels, batch_dist = get_cluster_info(batch, cluster_centers, metric=self._metric, dtype=self._dtype)
+            sums, counts = cluster_sums(batch, batch_labels, self._k)
+            center_counts += counts
+            hit = counts > 0
+            new_cluster_centers = cluster_centers.copy()
+            new_cluster_centers[hit] += (sums[hit] - counts[hit, np.newaxis]*cluster_centers[hit])/center_counts[hit, np.newaxis]
+            if callback is not None:
+                callback('iteration', iteration=counter, wall_time=timer() - batch_start,
+                         center_shift=center_shift(cluster_centers, new_cluster_centers),
+                         sse=float(np.sum(np.square(batch_dist, dtype=np.float64))))
             #break condition
             if np.allclose(cluster_centers, new_cluster_centers, self._atol, self._rtol):
                 break_cond = True
@@ -127,53 +644,241 @@ class KMeans(object):
                 break
             cluster_centers = new_cluster_centers
             counter = counter+1
+        if callback is not None:
+            callback('phase', phase='iteration', wall_time=timer() - iteration_start, iterations=counter)
+            assignment_start = timer()
 
-        cluster_labels, cluster_dist = get_cluster_info(self._data, cluster_centers, metric=self._metric)
-        self._cluster_centers = cluster_centers
-        #cutting of labels according to given list
-        if self._data_type_list:
-            cluster_labels=np.split(cluster_labels,self._traj_list_indices[:-1])
-            cluster_dist = np.split(cluster_dist,self._traj_list_indices[:-1])
-        self._cluster_labels = cluster_labels
-        self._cluster_dist = cluster_dist
+        self._set_results(cluster_centers)
+        if callback is not None:
+            callback('phase', phase='assignment', wall_time=timer() - assignment_start)
+            callback('fit', wall_time=timer() - start_time, iterations=counter, converged=break_cond,
+                     n_clusters=self._k, **self._distance_summary())
+
+    def sse_curve(self,n_clusters,warm_start=True,n_jobs=1):
+        '''
+        as KMeans.sse_curve, all fits are mini-batch fits run in this process, so n_jobs has to be 1
+        '''
+        if n_jobs != 1:
+            raise InvalidValue('MiniBatchKMeans fits the SSE curve in this process, n_jobs has to be 1')
+        return super(MiniBatchKMeans,self).sse_curve(n_clusters,warm_start=warm_start,n_jobs=1)
 
-        self._fitted = True
-        if self._verbose:
-            if break_cond:
-                print('terminated by break condition')
-            print('%s iterations until termination.' % str(counter))
-            elapsed_time = timer() - start_time
-            elapsed_time = timedelta(seconds=elapsed_time)
-            print('Finished after '+str(elapsed_time))
-            print('max within-cluster distance to center: %f'%np.max(self._cluster_dist))
-            print('mean within-cluster distance to center: %f' %np.mean(self._cluster_dist))
-            print('sum of within cluster squared errors: %f' % np.sum(np.square(self._cluster_dist)))
 
+class BisectingKMeans(ClusteringBase):
+    '''
+    Bisecting (hierarchical) variant of euclidean KMeans for large k. Starting from a single cluster, the cluster
+    with the largest within-cluster SSE (or the most observations) is repeatedly split in two by KMeans with k=2,
+    until k clusters are found. Each split only touches the observations of the split cluster.
+
+    The splits form a binary tree of centers: every observation lies in the leaf reached by descending from the
+    root to the closer child center, which is how fitted and new data are assigned. An assignment costs one
+    distance per tree level instead of k distances, the result may however differ from the nearest of the final
+    centers near cluster boundaries. assignment='nearest' assigns to the nearest center instead.
+    '''
 
-    def transform(self,data):
+    def __init__(self,data,k,max_iter=150,method="forgy",atol=1e-03,rtol=1e-03,verbose=True,n_init=1,
+                 strategy='sse',assignment='tree',random_state=None,out_of_core=None,output_dir=None,dtype=None,
+                 listeners=None,stride=1,subsample=None):
         '''
-        Returns cluster labeling for additional data corresponding
-        to existing cluster centers stored in the object. (Also fits to initial data, if not fitted before)
         Args:
-            data: (n,d)-shaped ndarray or list consisting of ndarrays each with matching second dimension d
-        Returns:
-            cluster labels for passed data argument and cluster distances with respect to the given metric
+            data: (n,d)-shaped 2-dimensional ndarray objects containing float data or a list consisting of
+            fitting ndarrays, numpy.memmap arrays or paths to .npy files
+            k: int, number of clusters (leaves of the tree). Fewer clusters are found if no cluster with distinct
+            observations is left to split.
+            max_iter, method, atol, rtol: settings of the KMeans runs splitting a cluster, see KMeans
+            n_init: int, number of runs per split, the split with the lowest SSE is kept
+            strategy: 'sse' splits the cluster with the largest within-cluster SSE, 'size' the cluster with the most
+            observations
+            assignment: 'tree' assigns data by descending the tree of centers, 'nearest' to the nearest center
+            random_state: None, int seed or numpy.random.Generator used for the initializations and subsample
+            out_of_core, output_dir: streaming of list data, see KMeans. The splits run in memory, so out-of-core
+            data has to be fitted on a subsample (see stride and subsample) and is then assigned block by block.
+            dtype: floating point precision of data, centers and distances, see KMeans
+            listeners: list of callables receiving the fit records, see KMeans. An iteration record is emitted
+            for every split.
+            stride, subsample: fit the tree on selected frames only, see KMeans
         '''
-        array_type = type(data)
-        if array_type is list:
-            data, traj_list_indices = concat_list(data)
+        if strategy not in ('sse', 'size'):
+            raise InvalidValue('Unknown bisecting strategy %s' % strategy)
+        if assignment not in ('tree', 'nearest'):
+            raise InvalidValue('Unknown assignment %s' % assignment)
+        self._data = data
+        self._k = k
+        self._max_iter = max_iter
+        self._method = method
+        self._metric = 'euclidean'
+        self._atol = atol
+        self._rtol = rtol
+        self._n_init = n_init
+        self._strategy = strategy
+        self._assignment = assignment
+        self._random_state = random_state
+        self._cluster_centers = None
+        self._cluster_labels = None
+        self._cluster_dist = None
+        self._node_centers = None
+        self._node_children = None
+        self._node_clusters = None
+        self._traj_list_indices = None
+        self._verbose = verbose
+        self._fitted = False
+        self._data_type_list = None
+        self._out_of_core = out_of_core
+        self._output_dir = output_dir
+        self._dtype = dtype
+        self._listeners = [] if listeners is None else list(listeners)
+        self._stride = stride
+        self._subsample = subsample
 
-        if not self._fitted:
+    @property
+    def node_centers(self):
+        '''(m,d) ndarray of the centers of all nodes of the tree, the root first'''
+        if self._node_centers is None:
             self.fit()
+        return self._node_centers
 
-        cluster_labels, cluster_dist = get_cluster_info(data, self.cluster_centers, metric=self._metric)
+    @property
+    def node_children(self):
+        '''(m,2) int ndarray of the indices of the two children of each node, -1 for leaves'''
+        if self._node_children is None:
+            self.fit()
+        return self._node_children
 
-        if array_type is list:
-            cluster_labels = np.split(cluster_labels, traj_list_indices[:-1])
-            cluster_dist = np.split(cluster_dist, traj_list_indices[:-1])
+    @property
+    def node_clusters(self):
+        '''(m,) int ndarray of the cluster index of each leaf, -1 for inner nodes'''
+        if self._node_clusters is None:
+            self.fit()
+        return self._node_clusters
 
-        self._fitted = True
-        return cluster_labels, cluster_dist
+    def fit(self,k=None,verbose=None):
+        '''
+        Builds the tree of centers by bisecting the data until k clusters are found and assigns the data. The
+        clusters are numbered by a depth first traversal of the tree, so clusters of a subtree have consecutive
+        indices. k and verbose can be changed for a refit.
+        '''
+        if k is not None:
+            self._k = k
+        if verbose is not None:
+            self._verbose = verbose
+        callback = self._callback()
+        start_time = timer()
+        self._prepare_data()
+        random_state = check_random_state(self._random_state)
+        data = self._fit_data(random_state)
+        if type(data) is list:
+            raise InvalidValue('BisectingKMeans fits in memory, use stride or subsample for out-of-core data')
+        settings = (2, self._method, 'lloyd', self._max_iter, self._metric, self._atol, self._rtol)
+
+        root = np.mean(data, axis=0, dtype=np.float64)
+        node_centers = [root]
+        node_children = [[-1, -1]]
+        #members and sse of the leaves containing distinct observations, by node index
+        leaves = {}
+        if np.any(data != data[0]):
+            leaves[0] = (np.arange(data.shape[0]), np.sum(np.square(data - root, dtype=np.float64)))
+        n_clusters = 1
+        while n_clusters < self._k and leaves:
+            if callback is not None:
+                split_start = timer()
+            if self._strategy == 'sse':
+                node = max(leaves, key=lambda node: leaves[node][1])
+            else:
+                node = max(leaves, key=lambda node: len(leaves[node][0]))
+            members, sse = leaves.pop(node)
+            points = data[members]
+            restarts = [kmeans_restart(points, *settings, random_state=random_state, dtype=self._dtype)
+                        for i in range(self._n_init)]
+            centers = restarts[int(np.argmin([restart[3] for restart in restarts]))][0]
+            labels, dist = get_cluster_info(points, centers, dtype=self._dtype)
+            node_children[node] = [len(node_centers), len(node_centers) + 1]
+            for child in range(2):
+                in_child = labels == child
+                if np.any(points[in_child] != points[in_child][:1]):
+                    leaves[len(node_centers)] = (members[in_child],
+                                                 np.sum(np.square(dist[in_child], dtype=np.float64)))
+                node_centers.append(centers[child])
+                node_children.append([-1, -1])
+            n_clusters += 1
+            if callback is not None:
+                callback('iteration', iteration=n_clusters - 2, wall_time=timer() - split_start,
+                         n_clusters=n_clusters, sse=float(sse))
+        if callback is not None:
+            callback('phase', phase='bisection', wall_time=timer() - start_time)
+            assignment_start = timer()
+
+        self._set_tree(np.array(node_centers, dtype=float if self._dtype is None else self._dtype),
+                       np.array(node_children, dtype=np.intp))
+        self._set_results(self._cluster_centers)
+        if callback is not None:
+            callback('phase', phase='assignment', wall_time=timer() - assignment_start)
+            callback('fit', wall_time=timer() - start_time, n_clusters=len(self._cluster_centers),
+                     **self._distance_summary())
+
+    def _set_tree(self,node_centers,node_children):
+        '''
+        stores the tree and numbers its leaves by a depth first traversal
+        '''
+        node_clusters = np.full(len(node_children), -1, dtype=np.intp)
+        leaves = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if node_children[node, 0] < 0:
+                node_clusters[node] = len(leaves)
+                leaves.append(node)
+            else:
+                stack.extend(node_children[node, ::-1])
+        self._node_centers = node_centers
+        self._node_children = node_children
+        self._node_clusters = node_clusters
+        self._cluster_centers = node_centers[leaves]
+        #an observation x is closer to the second child center c2 than to the first c1 iff
+        #x.(c2 - c1) > (|c2|^2 - |c1|^2)/2
+        first = node_centers[np.maximum(node_children[:, 0], 0)].astype(np.float64)
+        second = node_centers[np.maximum(node_children[:, 1], 0)].astype(np.float64)
+        self._node_normals = second - first
+        self._node_offsets = 0.5*(squared_norms(second) - squared_norms(first))
+
+    def _assign(self,data):
+        '''
+        descends the tree node by node: the observations of a node move on to the closer of its two child centers,
+        decided by one matrix-vector product with the normal of the hyperplane between them. Ties go to the first
+        child as in get_cluster_info.
+        '''
+        if self._assignment == 'nearest':
+            return get_cluster_info(data, self._cluster_centers, dtype=self._dtype)
+        data = np.asarray(data)
+        nodes = np.zeros(data.shape[0], dtype=np.intp)
+        stack = [(0, np.arange(data.shape[0]))]
+        while stack:
+            node, members = stack.pop()
+            first, second = self._node_children[node]
+            if first < 0:
+                nodes[members] = node
+                continue
+            closer_second = np.dot(data[members], self._node_normals[node]) > self._node_offsets[node]
+            stack.append((second, members[closer_second]))
+            stack.append((first, members[~closer_second]))
+        cluster_labels = self._node_clusters[nodes]
+        cluster_dist = np.sqrt(np.sum(np.square(data - self._cluster_centers[cluster_labels], dtype=np.float64),
+                                      axis=1))
+        return cluster_labels, cluster_dist.astype(np.float64 if self._dtype is None else self._dtype, copy=False)
+
+    def _params(self):
+        params = super(BisectingKMeans,self)._params()
+        del params['metric']
+        params.update(k=self._k, max_iter=self._max_iter, method=self._method, atol=self._atol, rtol=self._rtol,
+                      n_init=self._n_init, strategy=self._strategy, assignment=self._assignment)
+        if isinstance(self._random_state, (int, np.integer)):
+            params.update(random_state=int(self._random_state))
+        return params
+
+    def _model_arrays(self):
+        return dict(node_centers=self._node_centers, node_children=self._node_children)
+
+    def _restore(self,stored):
+        super(BisectingKMeans,self)._restore(stored)
+        self._set_tree(stored['node_centers'], stored['node_children'])
 
 
 
@@ -181,21 +886,38 @@ class KMeans(object):
 #Regspace clustering
 #-------------------
 
-class Regspace(object):
+class Regspace(ClusteringBase):
     '''Regular space clustering.'''
 
-    def __init__(self,data,max_centers,min_dist,metric='euclidean',verbose=True):
+    def __init__(self,data,max_centers,min_dist,metric='euclidean',verbose=True,out_of_core=None,output_dir=None,
+                 block_size=1024,algorithm='block',dtype=None,listeners=None,stride=1,subsample=None,random_state=None):
         '''
 
         Args:
             data: ndarray containing (n,d)-shaped float data or list of arrays each with coninciding second
-            dimension
+            dimension, numpy.memmap arrays or paths to .npy files
             max_centers: the maximal cluster centers to be determined by the algorithm before stopping iteration,
             integer greater than 0 required
             min_dist: the minimal distances between cluster centers
             metric: the metric used to determine distances d-dimensional space. Default = euclidean.
             See scipy.spatial.distance.cdist for possible metrics
+            out_of_core, output_dir: streaming of list data, see KMeans
+            block_size: number of consecutive frames screened against the existing centers at once
+            algorithm: 'block' screens frames against all existing centers, 'grid' only against the centers in
+            neighboring cells of a uniform grid with cell side min_dist (see GridIndex). The grid also serves the
+            final assignment. Both yield the same result, the grid pays off for many centers in up to GRID_MAX_DIM
+            (4) dimensions with the euclidean, cityblock or chebyshev metric and raises InvalidValue for more.
+            dtype: floating point precision of data, centers and distances, see KMeans
+            listeners: list of callables receiving the fit records, see KMeans. An iteration record with the number
+            of centers found so far is emitted for every block of frames read.
+            stride, subsample: select the frames the centers are chosen from, see KMeans. Frames are visited in
+            their order in the data.
+            random_state: None, int seed or numpy.random.Generator used for subsample
         '''
+        if algorithm not in ('block', 'grid'):
+            raise InvalidValue('Unknown Regspace algorithm %s' % algorithm)
+        if algorithm == 'grid' and metric not in GridIndex.metrics:
+            raise InvalidValue('The grid algorithm does not support the %s metric' % metric)
 
         self._data = data
         self._max_centers = max_centers
@@ -208,89 +930,388 @@ class Regspace(object):
         self._verbose = verbose
         self._fitted = False
         self._data_type_list = None
+        self._out_of_core = out_of_core
+        self._output_dir = output_dir
+        self._block_size = block_size
+        self._algorithm = algorithm
+        self._grid = None
+        self._tree = None
+        self._dtype = dtype
+        self._listeners = [] if listeners is None else list(listeners)
+        self._stride = stride
+        self._subsample = subsample
+        self._random_state = random_state
 
-    @property
-    def cluster_centers(self):
-        if self._cluster_centers is None:
-            self.fit()
-        return self._cluster_centers
 
-    @cluster_centers.setter
-    def cluster_centers(self, value):
-        self._cluster_centers = value
+    def fit(self):
+        '''
+        performs regspace clustering on the data and provides cluster centers, clusterlabels and cluster distances
+        '''
+        callback = self._callback()
+        start_time = timer()
+
+        self._prepare_data()
+        fit_data = self._fit_data(check_random_state(self._random_state))
+        trajs = fit_data if type(fit_data) is list else [fit_data]
+        self._grid = None
+        self._tree = None
+        if self._algorithm == 'grid':
+            self._grid = GridIndex(self._min_dist, self._metric)
+        cluster_centers = regspace_centers(trajs, self._max_centers, self._min_dist, self._metric, self._block_size,
+                                           self._grid, self._dtype, callback)
+        if callback is not None:
+            callback('phase', phase='center_selection', wall_time=timer() - start_time)
+            assignment_start = timer()
+
+        self._set_results(cluster_centers)
+
+        if callback is not None:
+            callback('phase', phase='assignment', wall_time=timer() - assignment_start)
+            callback('fit', wall_time=timer() - start_time, n_clusters=len(self._cluster_centers),
+                     **self._distance_summary())
+
+    def _params(self):
+        params = super(Regspace,self)._params()
+        params.update(max_centers=self._max_centers, min_dist=self._min_dist, block_size=self._block_size,
+                      algorithm=self._algorithm)
+        if isinstance(self._random_state, (int, np.integer)):
+            params.update(random_state=int(self._random_state))
+        return params
+
+    def _restore(self,stored):
+        super(Regspace,self)._restore(stored)
+        if self._algorithm == 'grid':
+            self._grid = GridIndex(self._min_dist, self._metric)
+            self._grid.add(self._cluster_centers)
+
+    def _assign(self,data):
+        '''
+        nearest center lookup by the grid index if fitted with it, else by a KD-tree over the centers for suitable
+        metrics and dimensions (see center_tree and tree_nearest), else by get_cluster_info
+        '''
+        if self._grid is not None:
+            cluster_labels, cluster_dist = self._grid.nearest(data)
+            return cluster_labels, np.asarray(cluster_dist, dtype=self._dtype)
+        if self._tree is None or self._tree[0] is not self._cluster_centers:
+            self._tree = (self._cluster_centers, center_tree(self._cluster_centers, self._metric))
+        tree = self._tree[1]
+        if tree is False:
+            return get_cluster_info(data, self._cluster_centers, metric=self._metric, dtype=self._dtype)
+        cluster_labels, cluster_dist = tree_nearest(tree, self._cluster_centers, data, self._metric)
+        return cluster_labels, np.asarray(cluster_dist, dtype=self._dtype)
+
+
+#--------------------
+#spatial grid index
+#--------------------
+
+class GridIndex(object):
+    '''
+    Uniform grid over a growing set of points (cluster centers) with cells of side cell_size. Any point within
+    distance cell_size of a query lies in one of the 3^d cells neighboring the query cell, for all metrics bounding the
+    coordinate differences, so radius and nearest neighbor queries only need to inspect these cells. As their number
+    grows exponentially, points of at most GRID_MAX_DIM dimensions are supported.
+
+    Cells are identified by a linear hash of their integer coordinates. The point indices are kept sorted by cell
+    hash, so the candidates of a whole block of queries are gathered with one binary search. Hash collisions only
+    add candidates and do not affect the results.
+    '''
 
-    @property
-    def cluster_labels(self):
-        if self._cluster_labels is None:
-            self.fit()
-        return self._cluster_labels
+    #: metrics d(x,y) with |x_i-y_i| <= d(x,y) for each coordinate i
+    metrics = ('euclidean', 'cityblock', 'chebyshev')
 
-    @cluster_labels.setter
-    def cluster_labels(self, value):
-        self._cluster_labels = value
+    def __init__(self,cell_size,metric='euclidean'):
+        if metric not in self.metrics:
+            raise InvalidValue('The grid index does not support the %s metric' % metric)
+        self._cell_size = cell_size
+        self._metric = metric
+        self._points = None
+        self._n_points = 0
+        self._keys = np.empty(0, dtype=np.int64)
+        self._order = np.empty(0, dtype=np.intp)
+        self._multipliers = None
+        self._offset_keys = None
 
     @property
-    def cluster_dist(self):
-        if self._cluster_dist is None:
-            self.fit()
-        return self._cluster_dist
+    def points(self):
+        if self._points is None:
+            return np.empty((0, 0))
+        return self._points[:self._n_points]
 
-    @cluster_dist.setter
-    def cluster_dist(self, value):
-        self._cluster_dist = value
+    def __len__(self):
+        return self._n_points
 
-    @property
-    def fitted(self):
-        return self._fitted
-    @property
-    def data(self):
-        return self._data
+    def cells(self,points):
+        '''
+        returns the integer cell coordinates of the given (n,d) points
+        '''
+        return np.floor(np.divide(points, self._cell_size)).astype(np.int64)
 
+    def _hash(self,cells):
+        with np.errstate(over='ignore'):
+            return np.dot(cells, self._multipliers)
 
-    def fit(self):
+    def add(self,points):
         '''
-        performs regspace clustering on the data and provides cluster centers, clusterlabels and cluster distances
+        appends the (m,d) points to the index
         '''
-        if self._verbose:
-            start_time = timer()
+        points = np.asarray(points)
+        if self._points is None:
+            dim = points.shape[1]
+            if dim > GRID_MAX_DIM:
+                raise InvalidValue('The grid index supports at most %i dimensions, the points have %i. Use block '
+                                   'screening instead.' % (GRID_MAX_DIM, dim))
+            self._points = np.empty((max(16, points.shape[0]), dim), dtype=points.dtype)
+            self._multipliers = np.random.default_rng(0).integers(1, 2**62, dim) | 1
+            offsets = np.array(list(itertools.product((-1, 0, 1), repeat=dim)), dtype=np.int64)
+            self._offset_keys = self._hash(offsets)
+        elif self._n_points + points.shape[0] > self._points.shape[0]:
+            grown = np.empty((max(2*self._points.shape[0], self._n_points + points.shape[0]), self._points.shape[1]),
+                             dtype=self._points.dtype)
+            grown[:self._n_points] = self._points[:self._n_points]
+            self._points = grown
+        self._points[self._n_points:self._n_points+points.shape[0]] = points
+        keys = np.concatenate([self._keys, self._hash(self.cells(points))])
+        order = np.concatenate([self._order, np.arange(self._n_points, self._n_points+points.shape[0])])
+        sort = np.argsort(keys, kind='stable')
+        self._keys, self._order = keys[sort], order[sort]
+        self._n_points += points.shape[0]
+
+    def candidates(self,points):
+        '''
+        returns all pairs (query index, point index) of the (n,d) query points and the indexed points lying in
+        neighboring cells, together with their distances
+        '''
+        with np.errstate(over='ignore'):
+            keys = (self._hash(self.cells(points))[:, np.newaxis] + self._offset_keys).ravel()
+        lower = np.searchsorted(self._keys, keys, side='left')
+        counts = np.searchsorted(self._keys, keys, side='right') - lower
+        total = np.sum(counts)
+        queries = np.repeat(np.arange(points.shape[0]), len(self._offset_keys))
+        queries = np.repeat(queries, counts)
+        positions = np.repeat(lower - np.cumsum(counts) + counts, counts) + np.arange(total)
+        indices = self._order[positions]
+        return queries, indices, paired_distances(points[queries], self._points[indices], self._metric)
+
+    def within(self,points,radius=None,memory_budget=None):
+        '''
+        returns a boolean array flagging the (n,d) points having an indexed point at distance <= radius
+        (default and maximum: cell_size). The points are processed in blocks as in nearest.
+        '''
+        if radius is None:
+            radius = self._cell_size
+        found = np.zeros(points.shape[0], dtype=bool)
+        if self._n_points == 0:
+            return found
+        for block in self._blocks(points, memory_budget):
+            queries, indices, pair_dist = self.candidates(points[block])
+            found[block] = np.bincount(queries[pair_dist <= radius], minlength=block.stop - block.start) > 0
+        return found
+
+    def nearest(self,points,memory_budget=None):
+        '''
+        returns index of and distance to the nearest indexed point for each of the (n,d) points, as
+        get_cluster_info(points, self.points). Points without an indexed point within cell_size are resolved by
+        a KD-tree over the indexed points (see tree_nearest). The points are processed in blocks whose candidate
+        pairs, estimated at one indexed point per neighboring cell, do not exceed memory_budget bytes (default
+        CHUNK_MEMORY).
+        '''
+        labels = np.zeros(points.shape[0], dtype=np.intp)
+        dist = np.full(points.shape[0], np.inf)
+        for block in self._blocks(points, memory_budget):
+            labels[block], dist[block] = self._nearest_block(points[block])
+        unresolved = np.flatnonzero(dist > self._cell_size)
+        if unresolved.size > 0:
+            labels[unresolved], dist[unresolved] = tree_nearest(cKDTree(self.points), self.points,
+                                                                points[unresolved], self._metric)
+        return labels, dist
+
+    def _blocks(self,points,memory_budget=None):
+        '''
+        returns slices of blocks of the (n,d) points whose candidate pairs, estimated at one indexed point per
+        neighboring cell, do not exceed memory_budget bytes (default CHUNK_MEMORY)
+        '''
+        return chunk_slices(points.shape[0], len(self._offset_keys)*(3*points.shape[1] + 6), memory_budget)
 
-        if self._data_type_list is None:
-            self._data_type_list = type(self._data) is list
+    def _nearest_block(self,points):
+        '''
+        returns index of and distance to the nearest indexed point in the neighboring cells of the (n,d) points,
+        infinite distances if there is none
+        '''
+        labels = np.zeros(points.shape[0], dtype=np.intp)
+        dist = np.full(points.shape[0], np.inf)
+        queries, indices, pair_dist = self.candidates(points)
+        order = np.lexsort((indices, pair_dist, queries))
+        queries, first = np.unique(queries[order], return_index=True)
+        labels[queries] = indices[order[first]]
+        dist[queries] = pair_dist[order[first]]
+        return labels, dist
 
-        if self._data_type_list and not self._fitted:
-            self._data,self._traj_list_indices = concat_list(self._data)
-        center_list = [self._data[0, :]]
-        num_observations,d = self._data.shape
 
-        for i in range(1,num_observations):
-            if len(center_list) >= self._max_centers:
-                break
-            x_active = self._data[i, :]
-            distances = distance.cdist(x_active.reshape(1,d), np.array(center_list).reshape(len(center_list),d), metric=self._metric)
-            if np.all(distances > self._min_dist):
-                center_list.append(x_active)
-
-        cluster_centers = np.array(center_list)
-        cluster_labels, cluster_dist = get_cluster_info(self._data, cluster_centers, self._metric)
-        self.cluster_centers = cluster_centers
-        if self._data_type_list:
-            cluster_labels = np.split(cluster_labels, self._traj_list_indices[:-1])
-            cluster_dist = np.split(cluster_dist, self._traj_list_indices[:-1])
-        self._cluster_labels = cluster_labels
-        self._cluster_dist = cluster_dist
-        self._fitted = True
+#--------------
+#distance kernels
+#--------------
+
+class DistanceKernel(object):
+    '''
+    Distances of blocks of data to fixed (k,d) cluster centers, as scipy.spatial.distance.cdist. The euclidean and
+    sqeuclidean metric are expanded into ||x||^2 - 2 x.c + ||c||^2, so that a block costs one matrix product (BLAS
+    GEMM) of the data and the centers, both extended by a column of squared norms and a column of ones. Data and
+    centers are shifted by the mean center to limit cancellation, the squared norms are accumulated in float64 and
+    the extended centers are computed once and reused for every block.
+    Negative squared distances from rounding are clamped to zero. The matrix product only screens for nearest,
+    within and pairs: all centers it cannot separate from the decision (nearest center or radius) within a bound
+    of its rounding errors are checked with the distances of paired_distances, so the results are exactly those
+    of cdist. Other metrics fall back to cdist.
+
+    >>> kernel = DistanceKernel(cluster_centers)
+    >>> distance_matrix = kernel(data)
+    '''
+
+    #: metrics computed by the matrix product expansion
+    expanded_metrics = ('euclidean', 'sqeuclidean')
+
+    def __init__(self,cluster_centers,metric='euclidean',dtype=None):
+        '''
+        Args:
+            cluster_centers: (k,d) ndarray
+            metric: metric used as in scipy.spatial.distance.cdist
+            dtype: type of the distance blocks. numpy.float32 also computes the matrix product in single
+            precision. None (default) for float64.
+        '''
+        self._metric = metric
+        self._dtype = np.dtype(np.float64 if dtype is None else dtype)
+        self._cluster_centers = np.asarray(cluster_centers)
+        if metric in self.expanded_metrics:
+            k, dim = self._cluster_centers.shape
+            self._shift = np.mean(self._cluster_centers, axis=0, dtype=np.float64)
+            shifted_centers = self._cluster_centers - self._shift
+            self._extended_centers = np.empty((k, dim + 2), dtype=self._dtype)
+            self._extended_centers[:, :dim] = -2*shifted_centers
+            self._extended_centers[:, dim] = squared_norms(shifted_centers)
+            self._extended_centers[:, dim+1] = 1
+            self._max_center_norm = np.max(self._extended_centers[:, dim], initial=0)
+            #the rounding error of a product of extended vectors is bounded by (dim+2) eps times the sum of the
+            #absolute terms, which in turn is bounded by twice the sum of the squared norms
+            self._rounding_factor = 4*(dim + 2)*np.finfo(self._dtype).eps
 
-        if self._verbose:
-            elapsed_time = timer() - start_time
-            elapsed_time = timedelta(seconds=elapsed_time)
-            print('Finished after '+str(elapsed_time))
-            print('%i cluster centers detected'%len(self._cluster_centers)+'\n')
-            print('max within-cluster distance to center: %f'%np.max(self._cluster_dist))
-            print('mean within-cluster distance to center: %f' %np.mean(self._cluster_dist))
-            print('within cluster sum of squared errors: %f' % np.sum(np.square(self._cluster_dist)))
+    @property
+    def metric(self):
+        return self._metric
 
-    def transform(self,data):
-        raise NotImplementedError
+    @property
+    def cluster_centers(self):
+        return self._cluster_centers
+
+    @property
+    def block_columns(self):
+        '''
+        number of float64 columns allocated per observation of a block by nearest, pairs and within, to size blocks
+        with chunk_slices: the k distances, their boolean comparison mask in pairs and, for the expanded metrics,
+        about 3(d+2) columns for the extended data and the temporaries of rounding_bound and paired_distances
+        '''
+        k, dim = self._cluster_centers.shape
+        columns = k + (k + 7)//8
+        if self._metric not in self.expanded_metrics:
+            return columns
+        return columns + 3*(dim + 2)
+
+    def __call__(self,data):
+        '''
+        returns the (n,k) distance block of the (n,d) data
+        '''
+        if self._metric not in self.expanded_metrics:
+            return distance.cdist(data, self._cluster_centers, self._metric).astype(self._dtype, copy=False)
+        squared = self.squared(data)
+        if self._metric == 'sqeuclidean':
+            return squared
+        return np.sqrt(squared, out=squared)
+
+    def squared(self,data):
+        '''
+        returns the (n,k) block of squared euclidean distances of the (n,d) data
+        '''
+        squared = self._expansion(data)
+        return np.maximum(squared, 0, out=squared)
+
+    def _expansion(self,data):
+        '''
+        returns the (n,k) block ||x||^2 - 2 x.c + ||c||^2 of the (n,d) data, which can be slightly negative
+        '''
+        dim = data.shape[1]
+        extended_data = np.empty((data.shape[0], dim + 2), dtype=self._dtype)
+        np.subtract(data, self._shift, out=extended_data[:, :dim], casting='unsafe')
+        extended_data[:, dim] = 1
+        extended_data[:, dim+1] = squared_norms(extended_data[:, :dim])
+        return np.dot(extended_data, self._extended_centers.T)
+
+    def rounding_bound(self,data):
+        '''
+        returns a bound of the rounding errors of the squared distances of each of the (n,d) observations computed
+        by the matrix product (expanded metrics only)
+        '''
+        return self._rounding_factor*(squared_norms(data - self._shift) + self._max_center_norm)
+
+    def nearest(self,data,distance_matrix=None):
+        '''
+        returns index of and distance to the closest center for each of the (n,d) observations as the argmin of
+        cdist, i.e. ties go to the first center. For the expanded metrics all centers within twice the rounding
+        bound of the smallest entry of the matrix product are compared by their exact distances. A distance block of
+        the data computed before (by squared for the expanded metrics) can be passed as distance_matrix.
+        '''
+        if self._metric not in self.expanded_metrics:
+            distance_matrix = self(data) if distance_matrix is None else distance_matrix
+            cluster_labels = np.argmin(distance_matrix, axis=1)
+            return cluster_labels, distance_matrix[np.arange(distance_matrix.shape[0]), cluster_labels]
+        squared = self._expansion(data) if distance_matrix is None else distance_matrix
+        rows = np.arange(squared.shape[0])
+        cluster_labels = np.argmin(squared, axis=1)
+        closest = squared[rows, cluster_labels]
+        bound = closest + 2*self.rounding_bound(data)
+        if squared.shape[1] > 1:
+            #observations whose second closest entry is within the bound have several candidate centers
+            squared[rows, cluster_labels] = np.inf
+            unsure = np.flatnonzero(np.min(squared, axis=1) <= bound)
+            squared[rows, cluster_labels] = closest
+            if unsure.size > 0:
+                queries, indices = np.nonzero(squared[unsure] <= bound[unsure, np.newaxis])
+                pair_dist = paired_distances(data[unsure[queries]], self._cluster_centers[indices], self._metric)
+                order = np.lexsort((indices, pair_dist, queries))
+                first = order[np.flatnonzero(np.diff(queries[order], prepend=-1))]
+                cluster_labels[unsure] = indices[first]
+        cluster_dist = paired_distances(data, self._cluster_centers[cluster_labels], self._metric)
+        return cluster_labels, cluster_dist.astype(self._dtype, copy=False)
+
+    def pairs(self,data,radius,inclusive=False):
+        '''
+        returns the index arrays (observations, centers) of all pairs of the (n,d) observations and the centers at
+        distance < radius (<= radius if inclusive), sorted by observation and center. For the expanded metrics,
+        pairs passing the matrix product with a margin for its rounding errors are checked with paired_distances.
+        '''
+        if self._metric not in self.expanded_metrics:
+            #compared in float64 as the confirmed pairs of the expanded metrics
+            distance_matrix = distance.cdist(data, self._cluster_centers, self._metric)
+            return np.nonzero(distance_matrix <= radius if inclusive else distance_matrix < radius)
+        squared_radius = radius**2 if self._metric == 'euclidean' else radius
+        squared = self._expansion(data)
+        queries, indices = np.nonzero(squared <= squared_radius + self.rounding_bound(data)[:, np.newaxis])
+        pair_dist = paired_distances(data[queries], self._cluster_centers[indices], self._metric)
+        inside = pair_dist <= radius if inclusive else pair_dist < radius
+        return queries[inside], indices[inside]
+
+    def within(self,data,radius):
+        '''
+        returns a list containing the sorted indices of the centers at distance < radius for each of the (n,d)
+        observations, see pairs
+        '''
+        queries, indices = self.pairs(data, radius)
+        return np.split(indices, np.cumsum(np.bincount(queries, minlength=data.shape[0]))[:-1])
+
+    def covered(self,data,radius):
+        '''
+        returns a boolean array flagging the (n,d) observations having a center at distance <= radius, see pairs
+        '''
+        return np.bincount(self.pairs(data, radius, inclusive=True)[0], minlength=data.shape[0]) > 0
 
 
 #--------------
@@ -298,6 +1319,18 @@ class Regspace(object):
 #--------------
 
 
+def _label_file(path,name,index):
+    '''
+    returns the file name of the saved labels or distances of trajectory index of a model saved to path
+    '''
+    return '%s_%s_%i.npy' % (path[:-len('.npz')], name, index)
+
+def _subclasses(cls):
+    '''
+    returns all direct and indirect subclasses of cls
+    '''
+    return [subclass for direct in cls.__subclasses__() for subclass in [direct] + _subclasses(direct)]
+
 def concat_list(array_list):
     '''
     for a given list of ndarrays, concatenate to a single numpy array
@@ -309,26 +1342,653 @@ def concat_list(array_list):
     traj_list_indices = np.cumsum(traj_list_indices)
     return np.concatenate(array_list,axis=0), traj_list_indices
 
-def get_cluster_info(data,cluster_centers,metric='euclidean'):
+def center_tree(cluster_centers,metric='euclidean'):
+    '''
+    returns a cKDTree over the cluster centers for nearest center queries, or False if the metric is not in
+    KDTREE_METRICS or the dimension exceeds KDTREE_MAX_DIM, where brute force distances are preferable
+    '''
+    cluster_centers = np.asarray(cluster_centers)
+    if metric not in KDTREE_METRICS or cluster_centers.shape[1] > KDTREE_MAX_DIM:
+        return False
+    return cKDTree(cluster_centers)
+
+def tree_nearest(tree,cluster_centers,points,metric='euclidean'):
+    '''
+    returns index of and distance to the nearest center for each of the (n,d) points as get_cluster_info, using a
+    cKDTree over the (k,d) cluster centers. The tree rounds its distances on its own and breaks ties arbitrarily, so
+    all centers within a rounding margin of the nearest tree distance are compared by the distances of
+    paired_distances, ties going to the first center.
+    '''
+    p = KDTREE_METRICS[metric]
+    tree_dist, cluster_labels = tree.query(points, k=min(2, tree.n), p=p)
+    if tree.n > 1:
+        #points whose second nearest center is not clearly farther can have several nearest centers
+        unsure = np.flatnonzero(tree_dist[:, 1] <= tree_dist[:, 0]*(1 + 1e-9))
+        tree_dist, cluster_labels = tree_dist[:, 0], cluster_labels[:, 0]
+        if unsure.size > 0:
+            candidates = tree.query_ball_point(points[unsure], tree_dist[unsure]*(1 + 2e-9), p=p)
+            counts = np.array([len(candidate) for candidate in candidates], dtype=np.intp)
+            indices = np.fromiter(itertools.chain.from_iterable(candidates), dtype=np.intp, count=np.sum(counts))
+            queries = np.repeat(np.arange(unsure.size), counts)
+            pair_dist = paired_distances(points[unsure[queries]], cluster_centers[indices], metric)
+            order = np.lexsort((indices, pair_dist, queries))
+            first = order[np.flatnonzero(np.diff(queries[order], prepend=-1))]
+            cluster_labels[unsure] = indices[first]
+    cluster_labels = np.asarray(cluster_labels, dtype=np.intp)
+    return cluster_labels, paired_distances(points, cluster_centers[cluster_labels], metric)
+
+def is_out_of_core(data):
+    '''
+    returns True if data is a list containing .npy file paths or numpy.memmap arrays
+    '''
+    return type(data) is list and any(isinstance(traj, np.memmap) or not hasattr(traj, 'shape') for traj in data)
+
+def open_trajectories(trajs):
+    '''
+    returns the list of trajectories with .npy file paths replaced by read-only memory maps
+    '''
+    return [traj if hasattr(traj, 'shape') else np.load(traj, mmap_mode='r') for traj in trajs]
+
+def iter_trajectory_chunks(traj,chunk_size=None,dtype=None,dim=None,offset=0):
+    '''
+    iterates over a trajectory in blocks of chunk_size frames read through a memory map, so that only one block is
+    loaded at a time. chunk_size None yields blocks of at most CHUNK_MEMORY bytes.
+
+    Args:
+        traj: path of a .npy file, path of a raw binary file (e.g. written by numpy.ndarray.tofile) or an array
+        chunk_size: int, number of frames per block
+        dtype, dim: data type and number of columns of a raw binary file
+        offset: size in bytes of a header preceding the frames of a raw binary file
+    '''
+    if not hasattr(traj, 'shape'):
+        if str(traj).endswith('.npy'):
+            traj = np.load(traj, mmap_mode='r')
+        elif dtype is None or dim is None:
+            raise InvalidValue('Reading raw binary trajectories requires dtype and dim')
+        else:
+            traj = np.memmap(traj, dtype=dtype, mode='r', offset=offset).reshape(-1, dim)
+    if chunk_size is None:
+        blocks = chunk_slices(traj.shape[0], traj.shape[1], itemsize=traj.dtype.itemsize)
+    else:
+        blocks = [slice(start, start+chunk_size) for start in range(0, traj.shape[0], chunk_size)]
+    for block in blocks:
+        yield np.array(traj[block])
+
+def iter_blocks(trajs,n_columns,memory_budget=None,dtype=None):
+    '''
+    iterates over a list of trajectories in blocks of rows as given by chunk_slices and yields the trajectory index,
+    the row slice and the block loaded into memory (converted to dtype if given)
+    '''
+    for traj_index, traj in enumerate(trajs):
+        for block in chunk_slices(traj.shape[0], max(n_columns, traj.shape[1]), memory_budget):
+            yield traj_index, block, np.asarray(traj[block], dtype=dtype)
+
+def take_frames(trajs,indices):
+    '''
+    returns the observations with given sorted indices into the concatenation of a list of trajectories without
+    concatenating them
+    '''
+    traj_list_indices = np.cumsum([traj.shape[0] for traj in trajs])
+    starts = traj_list_indices - [traj.shape[0] for traj in trajs]
+    traj_indices = np.searchsorted(traj_list_indices, indices, side='right')
+    frames = [np.asarray(trajs[i][indices[traj_indices == i] - starts[i]]) for i in np.unique(traj_indices)]
+    return np.concatenate(frames)
+
+def assign_trajectories(trajs,cluster_centers,metric='euclidean',output_dir=None,assign=None,dtype=None,
+                        n_threads=1):
+    '''
+    computes cluster labels and distances for each trajectory of a list of (possibly memory mapped) trajectories
+    block by block. If output_dir is given, the results are written to labels_<i>.npy and dist_<i>.npy in that
+    directory and returned as numpy.memmap arrays. A callable assign(block) returning labels and distances
+    replaces get_cluster_info if given. Blocks are converted to dtype (see get_cluster_info), which is also the
+    type of the distances (default float64).
+
+    With n_threads > 1 (None for all cpus) the blocks of all trajectories are assigned on a thread pool. The
+    memory budget is then shared by the concurrent blocks, which are also kept small enough to give every thread
+    several of them.
+
+    Returns:
+        list of label arrays and list of distance arrays, one for each trajectory
+    '''
+    cluster_centers = np.asarray(cluster_centers)
+    dist_dtype = np.float64 if dtype is None else dtype
+    if n_threads is None:
+        n_threads = os.cpu_count()
+    memory_budget = None
+    if n_threads > 1:
+        n_columns = max([cluster_centers.shape[0]] + [traj.shape[1] for traj in trajs])
+        rows = -(-sum(traj.shape[0] for traj in trajs) // (4*n_threads))
+        memory_budget = min(CHUNK_MEMORY // n_threads, 8*n_columns*rows)
+    labels_list, dist_list, tasks = [], [], []
+    for traj_index, traj in enumerate(trajs):
+        n_samples = traj.shape[0]
+        if output_dir is None:
+            cluster_labels = np.empty(n_samples, dtype=np.intp)
+            cluster_dist = np.empty(n_samples, dtype=dist_dtype)
+        else:
+            cluster_labels = open_memmap(os.path.join(output_dir, 'labels_%i.npy' % traj_index), mode='w+',
+                                         dtype=np.intp, shape=(n_samples,))
+            cluster_dist = open_memmap(os.path.join(output_dir, 'dist_%i.npy' % traj_index), mode='w+',
+                                       dtype=dist_dtype, shape=(n_samples,))
+        for block in chunk_slices(n_samples, max(cluster_centers.shape[0], traj.shape[1]), memory_budget):
+            tasks.append((traj_index, block))
+        labels_list.append(cluster_labels)
+        dist_list.append(cluster_dist)
+
+    def assign_block(task):
+        traj_index, block = task
+        frames = np.asarray(trajs[traj_index][block], dtype=dtype)
+        if assign is None:
+            labels_list[traj_index][block], dist_list[traj_index][block] = get_cluster_info(frames, cluster_centers,
+                                                                                            metric=metric, dtype=dtype)
+        else:
+            labels_list[traj_index][block], dist_list[traj_index][block] = assign(frames)
+
+    if n_threads > 1:
+        with ThreadPoolExecutor(n_threads) as pool:
+            list(pool.map(assign_block, tasks))
+    else:
+        for task in tasks:
+            assign_block(task)
+    return labels_list, dist_list
+
+def get_cluster_info(data,cluster_centers,metric='euclidean',memory_budget=None,dtype=None):
     '''
     For (n,d)-shaped float data and given centroids, returns the corresponding cluster centers and corresponding labeling
     with respect to a metric.
 
+    The distance matrix is computed in blocks of rows so that a single block does not exceed memory_budget bytes.
+
     Args:
         data: (n,d) ndarray
         cluster_centers: (k,d) ndarray
         metric: metric parameters used as in scipy.spatial.distance.cdist. uses euclidean metric as default.
+        The euclidean distances are computed by matrix products, see DistanceKernel.
+        memory_budget: maximal size in bytes of a distance block and the temporaries of its DistanceKernel (see
+        DistanceKernel.block_columns). Defaults to the module level CHUNK_MEMORY.
+        dtype: type of the distance blocks and distances, see pairwise_distances. None (default) for float64.
 
     Returns:
         cluster_labels: (d,1) vector containing the corresponding cluster centers of each of the data rows
         cluster_dist (d,1) vector containing squared distance of data observation to corresponding cluster centroid
     '''
-
-    distance_matrix = distance.cdist(data,cluster_centers,metric)
-    cluster_labels = np.argmin(distance_matrix,axis=1)
-    cluster_dist = np.min(distance_matrix,axis=1)
+    cluster_centers = np.asarray(cluster_centers)
+    dist_dtype = np.dtype(np.float64 if dtype is None else dtype)
+    n_samples = data.shape[0]
+    cluster_labels = np.empty(n_samples, dtype=np.intp)
+    cluster_dist = np.empty(n_samples, dtype=dist_dtype)
+    kernel = DistanceKernel(cluster_centers, metric, dtype)
+    for block in chunk_slices(n_samples, kernel.block_columns, memory_budget):
+        cluster_labels[block], cluster_dist[block] = kernel.nearest(data[block])
     return cluster_labels, cluster_dist
 
+def chunk_slices(n_samples,n_columns,memory_budget=None,itemsize=8):
+    '''
+    returns slices partitioning range(n_samples) into blocks of rows, such that a block with n_columns columns of
+    itemsize bytes (default float64) does not exceed memory_budget bytes (default CHUNK_MEMORY). Each block contains
+    at least one row.
+    '''
+    if memory_budget is None:
+        memory_budget = CHUNK_MEMORY
+    block_size = max(1, int(memory_budget // (itemsize*max(n_columns, 1))))
+    return [slice(start, min(start+block_size, n_samples)) for start in range(0, n_samples, block_size)]
+
+def pairwise_distances(data,cluster_centers,metric='euclidean',dtype=None):
+    '''
+    returns the (n,k) distance block of (n,d) data and (k,d) cluster centers as scipy.spatial.distance.cdist in
+    dtype (default float64). Euclidean and sqeuclidean distances are computed by a matrix product, see
+    DistanceKernel, which should be used directly to reuse the center norms for several blocks.
+    '''
+    return DistanceKernel(cluster_centers, metric, dtype)(data)
+
+def squared_norms(data):
+    '''
+    returns the squared euclidean norms of the rows of (n,d) data, accumulated in float64
+    '''
+    return np.einsum('ij,ij->i', data, data, dtype=np.float64)
+
+def paired_distances(data,other,metric='euclidean'):
+    '''
+    returns the float64 distances between corresponding rows of (n,d) data and (n,d) other for the euclidean,
+    sqeuclidean, cityblock and chebyshev metric. The coordinate differences are accumulated column by column in the
+    order of scipy.spatial.distance.cdist, so the distances are identical to the ones of cdist. Used to confirm
+    candidate pairs found with rounding errors, e.g. by a matrix product or a KD-tree.
+    '''
+    diff = np.subtract(data, other, dtype=np.float64)
+    if metric in ('euclidean', 'sqeuclidean'):
+        np.square(diff, out=diff)
+    elif metric in ('cityblock', 'chebyshev'):
+        np.abs(diff, out=diff)
+    else:
+        raise InvalidValue('Paired distances do not support the %s metric' % metric)
+    if metric == 'chebyshev':
+        return np.max(diff, axis=1, initial=0)
+    pair_dist = np.zeros(diff.shape[0])
+    for column in diff.T:
+        pair_dist += column
+    return np.sqrt(pair_dist, out=pair_dist) if metric == 'euclidean' else pair_dist
+
+def regspace_centers(trajs,max_centers,min_dist,metric='euclidean',block_size=1024,grid=None,dtype=None,
+                     callback=None):
+    '''
+    selects regular space cluster centers from a list of trajectories: a frame becomes a new center if its distance
+    to all previously selected centers exceeds min_dist, until max_centers centers are found.
+
+    Frames are processed in blocks of block_size. All frames of a block are screened against the existing centers
+    in memory bounded sub-blocks, the remaining candidates are resolved in order against each other, which gives
+    the same centers as checking frame by frame. If an empty GridIndex with cell side min_dist is given, blocks are
+    only screened against the centers in neighboring cells, and the selected centers are added to the grid. Blocks
+    are converted to dtype if given, see pairwise_distances. A callback(event, **fields) receives an iteration
+    record for every block read (see instrumentation.Instrumented).
+
+    Returns:
+        (m,d) ndarray of cluster centers, m <= max_centers
+    '''
+    cluster_centers = None
+    n_centers = 0
+    for iteration, (traj_index, rows, frames) in enumerate(iter_blocks(trajs, max_centers, dtype=dtype)):
+        if callback is not None:
+            block_start = timer()
+        for start in range(0, frames.shape[0], block_size):
+            if n_centers >= max_centers:
+                break
+            block = frames[start:start+block_size]
+            if cluster_centers is None:
+                cluster_centers = np.empty((max_centers, block.shape[1]), dtype=block.dtype)
+            candidates = block
+            if grid is not None:
+                candidates = block[~grid.within(block, min_dist)]
+            elif n_centers > 0:
+                kernel = DistanceKernel(cluster_centers[:n_centers], metric, dtype)
+                covered = np.empty(block.shape[0], dtype=bool)
+                for sub_block in chunk_slices(block.shape[0], kernel.block_columns):
+                    covered[sub_block] = kernel.covered(block[sub_block], min_dist)
+                candidates = block[~covered]
+            if candidates.shape[0] == 0:
+                continue
+            accepted = _resolve_candidates(candidates, min_dist, metric, max_centers - n_centers, dtype)
+            cluster_centers[n_centers:n_centers+len(accepted)] = candidates[accepted]
+            n_centers += len(accepted)
+            if grid is not None:
+                grid.add(candidates[accepted])
+        if callback is not None:
+            callback('iteration', iteration=iteration, wall_time=timer() - block_start, n_centers=n_centers)
+        if n_centers >= max_centers:
+            break
+    if cluster_centers is None:
+        return np.empty((0, 0))
+    return cluster_centers[:n_centers]
+
+def _resolve_candidates(candidates,min_dist,metric,max_accepted,dtype=None):
+    '''
+    returns the indices of the candidates that are accepted as centers when processed in order, i.e. candidates
+    farther than min_dist from all previously accepted candidates
+    '''
+    close = np.zeros((candidates.shape[0], candidates.shape[0]), dtype=bool)
+    close[DistanceKernel(candidates, metric, dtype).pairs(candidates, min_dist, inclusive=True)] = True
+    alive = np.ones(candidates.shape[0], dtype=bool)
+    accepted = []
+    next_candidate = 0
+    while len(accepted) < max_accepted:
+        remaining = np.flatnonzero(alive[next_candidate:])
+        if remaining.size == 0:
+            break
+        j = next_candidate + remaining[0]
+        accepted.append(j)
+        alive &= ~close[:, j]
+        next_candidate = j + 1
+    return accepted
+
+def kmeans_restart(data,k,method,algorithm,max_iter,metric='euclidean',atol=1e-03,rtol=1e-03,random_state=None,
+                   dtype=None,init_centers=None,callback=None,sample_weight=None,assignment=False,output_dir=None):
+    '''
+    runs one initialization and iteration of KMeans as configured by the KMeans constructor arguments. A list of
+    trajectories is treated as out-of-core data, see streamed_lloyd_iterate. dtype is the floating point type of the
+    cluster centers and distances (default float64). Given init_centers replace the initialization. A
+    callback(event, **fields) receives the phase and iteration records (see instrumentation.Instrumented).
+    Optional sample weights of in-memory data weight the initialization, the centroid updates and the SSE.
+
+    The SSE is computed by a final assignment of the data to the resulting centers. With assignment=True its labels
+    and distances are returned as well (lists for out-of-core data, written to output_dir if given, see
+    assign_trajectories), so that the caller does not need to assign the data again. Otherwise the SSE of
+    out-of-core data is accumulated block by block, see streamed_sse.
+
+    Returns:
+        cluster_centers, counter, break_cond: as in lloyd_iterate
+        sse: within-cluster sum of squared errors of the resulting centers
+        elapsed: wall time of the run in seconds
+        (cluster_labels, cluster_dist): the final assignment, only with assignment=True
+    '''
+    start_time = timer()
+    if type(data) is list and sample_weight is not None:
+        raise InvalidValue('Sample weights are only supported for in-memory data')
+    if type(data) is list:
+        #out-of-core trajectories, initialize on a subsample
+        if init_centers is None:
+            random_state = check_random_state(random_state)
+            n_samples = sum(traj.shape[0] for traj in data)
+            init_size = min(n_samples, max(100*k, 10000))
+            init_data = take_frames(data, np.sort(random_state.choice(n_samples, init_size, replace=False)))
+            init_centers = initialize_centers(init_data, k, method, random_state)
+        if callback is not None:
+            callback('phase', phase='initialization', wall_time=timer() - start_time)
+            iteration_start = timer()
+        cluster_centers, counter, break_cond = streamed_lloyd_iterate(data, init_centers, k, max_iter, metric,
+                                                                      atol, rtol, dtype, callback)
+        if callback is not None:
+            callback('phase', phase='iteration', wall_time=timer() - iteration_start, iterations=counter)
+        if assignment:
+            cluster_labels, cluster_dist = assign_trajectories(data, cluster_centers, metric, output_dir, dtype=dtype)
+            sse = distance_summary(cluster_dist)['sse']
+        else:
+            sse = streamed_sse(data, cluster_centers, metric, dtype)
+    else:
+        if init_centers is None:
+            init_centers = initialize_centers(data, k, method, random_state, sample_weight)
+        if callback is not None:
+            callback('phase', phase='initialization', wall_time=timer() - start_time)
+            iteration_start = timer()
+        if algorithm == 'hamerly':
+            cluster_centers, counter, break_cond = hamerly_iterate(data, init_centers, k, max_iter, atol, rtol,
+                                                                   dtype, callback, sample_weight)
+        else:
+            cluster_centers, counter, break_cond = lloyd_iterate(data, init_centers, k, max_iter, metric, atol, rtol,
+                                                                 dtype, callback, sample_weight)
+        if callback is not None:
+            callback('phase', phase='iteration', wall_time=timer() - iteration_start, iterations=counter)
+        cluster_labels, cluster_dist = get_cluster_info(data, cluster_centers, metric=metric, dtype=dtype)
+        sse = weighted_sse(cluster_dist, sample_weight)
+    if assignment:
+        return cluster_centers, counter, break_cond, sse, timer() - start_time, (cluster_labels, cluster_dist)
+    return cluster_centers, counter, break_cond, sse, timer() - start_time
+
+def parallel_restarts(data,settings,n_init,n_jobs=None,random_state=None,dtype=None,sample_weight=None):
+    '''
+    runs n_init calls of kmeans_restart(data,*settings,dtype=dtype,sample_weight=sample_weight) on a pool of n_jobs
+    processes (None for all cpus), see parallel_kmeans
+    '''
+    return parallel_kmeans(data, [settings]*n_init, n_jobs, random_state, dtype, sample_weight)
+
+def parallel_kmeans(data,settings_list,n_jobs=None,random_state=None,dtype=None,sample_weight=None):
+    '''
+    runs kmeans_restart(data,*settings,dtype=dtype,sample_weight=sample_weight) for every settings tuple of
+    settings_list on a pool of n_jobs processes (None for all cpus) and returns the results in order. The data is
+    placed in shared memory once and read by all workers, each run gets its own seed drawn from random_state.
+    Requires Python >= 3.8 for multiprocessing.shared_memory.
+    '''
+    from multiprocessing import shared_memory
+    data = np.ascontiguousarray(data)
+    seeds = check_random_state(random_state).integers(0, 2**63-1, len(settings_list))
+    memory = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    try:
+        np.ndarray(data.shape, dtype=data.dtype, buffer=memory.buf)[...] = data
+        initargs = (memory.name, data.shape, data.dtype.str, sample_weight)
+        with closing(multiprocessing.Pool(n_jobs, initializer=_attach_shared_data, initargs=initargs)) as pool:
+            restarts = pool.map(_shared_restart, [tuple(settings) + (int(seed), dtype)
+                                                  for settings, seed in zip(settings_list, seeds)])
+            pool.close()
+            pool.join()
+    finally:
+        memory.close()
+        memory.unlink()
+    return restarts
+
+_shared = {}
+
+def _attach_shared_data(name,shape,dtype,sample_weight=None):
+    from multiprocessing import shared_memory
+    _shared['memory'] = shared_memory.SharedMemory(name=name)
+    _shared['data'] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=_shared['memory'].buf)
+    _shared['sample_weight'] = sample_weight
+
+def _shared_restart(args):
+    return kmeans_restart(_shared['data'], *args, sample_weight=_shared['sample_weight'])
+
+def lloyd_iterate(data,cluster_centers,k,max_iter,metric='euclidean',atol=1e-03,rtol=1e-03,dtype=None,callback=None,
+                  sample_weight=None):
+    '''
+    runs Lloyd iterations (assignment and centroid update) starting from given cluster centers until the centers
+    are numpy.allclose to the previous ones or max_iter iterations are reached. The centers are kept in dtype if
+    given, see get_cluster_info. A callback(event, **fields) receives an iteration record with wall time, center
+    shift and the SSE of the assignment for every iteration. Optional sample weights weight the centroid updates
+    and the SSE.
+
+    Returns:
+        cluster_centers: (k,d) ndarray of the final centers
+        counter: number of iterations performed
+        break_cond: True if the iteration terminated by the break condition
+    '''
+    cluster_centers = np.array(cluster_centers, dtype=float if dtype is None else dtype)
+    counter = 0
+    break_cond = False # flags the termination by break condition
+
+    while counter < max_iter:
+        if callback is not None:
+            iteration_start = timer()
+        cluster_labels, cluster_dist = get_cluster_info(data, cluster_centers, metric=metric, dtype=dtype)
+        new_cluster_centers = np.asarray(set_new_cluster_centers(data, cluster_labels, k, cluster_dist, sample_weight),
+                                         dtype=dtype)
+        if callback is not None:
+            callback('iteration', iteration=counter, wall_time=timer() - iteration_start,
+                     center_shift=center_shift(cluster_centers, new_cluster_centers),
+                     sse=weighted_sse(cluster_dist, sample_weight))
+        #break condition
+        if np.allclose(cluster_centers, new_cluster_centers, atol, rtol):
+            break_cond = True
+            cluster_centers = new_cluster_centers
+            break
+        cluster_centers = new_cluster_centers
+        counter = counter+1
+    return cluster_centers, counter, break_cond
+
+def streamed_lloyd_iterate(trajs,cluster_centers,k,max_iter,metric='euclidean',atol=1e-03,rtol=1e-03,dtype=None,
+                           callback=None):
+    '''
+    Lloyd iterations over a list of (possibly memory mapped) trajectories, which are streamed in blocks. Each
+    iteration accumulates the per-cluster sums (in float64) and counts block by block, together with the k
+    observations farthest from their centers, which are used to reseed empty clusters. Blocks and centers are
+    converted to dtype if given. Returns the same as lloyd_iterate and reports to callback as lloyd_iterate.
+    '''
+    cluster_centers = np.array(cluster_centers, dtype=float if dtype is None else dtype)
+    counter = 0
+    break_cond = False # flags the termination by break condition
+
+    while counter < max_iter:
+        if callback is not None:
+            iteration_start = timer()
+            sse = 0.
+        sums = np.zeros(cluster_centers.shape)
+        counts = np.zeros(k, dtype=np.intp)
+        far_dist = np.empty(0)
+        far_frames = np.empty((0, cluster_centers.shape[1]), dtype=cluster_centers.dtype)
+        for traj_index, block, frames in iter_blocks(trajs, k, dtype=dtype):
+            cluster_labels, cluster_dist = get_cluster_info(frames, cluster_centers, metric=metric, dtype=dtype)
+            block_sums, block_counts = cluster_sums(frames, cluster_labels, k)
+            sums += block_sums
+            counts += block_counts
+            if callback is not None:
+                sse += np.sum(np.square(cluster_dist, dtype=np.float64))
+            far_dist = np.concatenate([far_dist, cluster_dist])
+            far_frames = np.concatenate([far_frames, frames])
+            if far_dist.size > k:
+                keep = np.argpartition(far_dist, -k)[-k:]
+                far_dist, far_frames = far_dist[keep], far_frames[keep]
+        empty = counts == 0
+        new_cluster_centers = np.divide(sums, np.where(empty, 1, counts)[:, np.newaxis]).astype(cluster_centers.dtype)
+        if np.any(empty):
+            new_cluster_centers = reseed_empty_clusters(far_frames, new_cluster_centers, empty, far_dist)
+        if callback is not None:
+            callback('iteration', iteration=counter, wall_time=timer() - iteration_start,
+                     center_shift=center_shift(cluster_centers, new_cluster_centers), sse=float(sse))
+        #break condition
+        if np.allclose(cluster_centers, new_cluster_centers, atol, rtol):
+            break_cond = True
+            cluster_centers = new_cluster_centers
+            break
+        cluster_centers = new_cluster_centers
+        counter = counter+1
+    return cluster_centers, counter, break_cond
+
+def hamerly_iterate(data,cluster_centers,k,max_iter,atol=1e-03,rtol=1e-03,dtype=None,callback=None,
+                    sample_weight=None):
+    '''
+    euclidean Lloyd iterations accelerated by Hamerlys algorithm, see
+    http://epubs.siam.org/doi/abs/10.1137/1.9781611972801.12
+
+    Each observation keeps an upper bound on the distance to its assigned center and a lower bound on the distance
+    to all other centers. Bounds are shifted by the center movements after each update, and distances are only
+    recomputed for observations whose upper bound exceeds both their lower bound and half the distance from their
+    center to the closest other center. Centers are kept in dtype if given (the bounds in float64). Returns the same
+    as lloyd_iterate. A callback(event, **fields) receives an iteration record with wall time, center shift and the
+    number of observations whose distances were recomputed for every iteration. Optional sample weights weight the
+    centroid updates.
+    '''
+    cluster_centers = np.array(cluster_centers, dtype=float if dtype is None else dtype)
+    cluster_labels, upper, lower = _two_nearest(data, cluster_centers, dtype)
+
+    counter = 0
+    break_cond = False # flags the termination by break condition
+
+    while counter < max_iter:
+        if callback is not None:
+            iteration_start = timer()
+        sums, counts = cluster_sums(data, cluster_labels, k, sample_weight)
+        empty = counts == 0
+        new_cluster_centers = np.divide(sums, np.where(empty, 1, counts)[:, np.newaxis]).astype(cluster_centers.dtype)
+        if np.any(empty):
+            cluster_dist = np.sqrt(np.sum(np.square(data - cluster_centers[cluster_labels]), axis=1))
+            new_cluster_centers = reseed_empty_clusters(data, new_cluster_centers, empty, cluster_dist)
+        #break condition
+        if np.allclose(cluster_centers, new_cluster_centers, atol, rtol):
+            if callback is not None:
+                callback('iteration', iteration=counter, wall_time=timer() - iteration_start,
+                         center_shift=center_shift(cluster_centers, new_cluster_centers), n_recomputed=0)
+            break_cond = True
+            cluster_centers = new_cluster_centers
+            break
+
+        #shift bounds by center movements
+        movement = np.sqrt(np.sum(np.square(new_cluster_centers - cluster_centers), axis=1))
+        cluster_centers = new_cluster_centers
+        counter = counter+1
+        upper += movement[cluster_labels]
+        if k > 1:
+            largest = np.argmax(movement)
+            second_movement = np.max(np.delete(movement, largest))
+            lower -= np.where(cluster_labels == largest, second_movement, movement[largest])
+
+        #half distance of each center to its closest other center, bounded from below by the second nearest
+        #center distance, in memory bounded blocks
+        half_gap = 0.5*_two_nearest(cluster_centers, cluster_centers, dtype)[2]
+
+        bound = np.maximum(half_gap[cluster_labels], lower)
+        candidates = np.flatnonzero(upper > bound)
+        if candidates.size > 0:
+            #tighten upper bounds and recompute all distances where that does not suffice
+            upper[candidates] = np.sqrt(np.sum(np.square(data[candidates] - cluster_centers[cluster_labels[candidates]]), axis=1))
+            candidates = candidates[upper[candidates] > bound[candidates]]
+        if candidates.size > 0:
+            nearest = _two_nearest(data[candidates], cluster_centers, dtype)
+            cluster_labels[candidates], upper[candidates], lower[candidates] = nearest
+        if callback is not None:
+            callback('iteration', iteration=counter-1, wall_time=timer() - iteration_start,
+                     center_shift=float(np.max(movement)), n_recomputed=candidates.size)
+
+    return cluster_centers, counter, break_cond
+
+def _two_nearest(data,cluster_centers,dtype=None):
+    '''
+    returns index and euclidean distance of the closest and the distance of the second closest center for each
+    observation, computed in memory bounded blocks of dtype as in get_cluster_info
+    '''
+    n_samples, k = data.shape[0], cluster_centers.shape[0]
+    labels = np.empty(n_samples, dtype=np.intp)
+    nearest = np.empty(n_samples)
+    second = np.full(n_samples, np.inf)
+    kernel = DistanceKernel(cluster_centers, dtype=dtype)
+    for block in chunk_slices(n_samples, kernel.block_columns):
+        squared = kernel.squared(data[block])
+        rows = np.arange(squared.shape[0])
+        labels[block], nearest[block] = kernel.nearest(data[block], squared)
+        if k > 1:
+            #lowered by the rounding bound of the matrix product to remain a lower bound
+            squared[rows, labels[block]] = np.inf
+            second[block] = np.sqrt(np.maximum(np.min(squared, axis=1) - kernel.rounding_bound(data[block]), 0))
+    return labels, nearest, second
+
+def center_shift(cluster_centers,new_cluster_centers):
+    '''
+    returns the largest euclidean distance between corresponding old and new cluster centers
+    '''
+    movement = np.sum(np.square(np.subtract(new_cluster_centers, cluster_centers, dtype=np.float64)), axis=1)
+    return float(np.sqrt(np.max(movement, initial=0)))
+
+def weighted_sse(cluster_dist,sample_weight=None):
+    '''
+    returns the within-cluster sum of squared errors of given distances to the assigned centers, optionally
+    weighted by sample weights
+    '''
+    squared = np.square(cluster_dist, dtype=np.float64)
+    if sample_weight is None:
+        return float(np.sum(squared))
+    return float(np.dot(squared, sample_weight))
+
+def distance_summary(dist_list,sample_weight=None):
+    '''
+    returns the maximal distance, the mean distance and the within-cluster SSE of a list of (possibly memory
+    mapped) distance arrays as a dict with keys max_dist, mean_dist and sse. The arrays are read in blocks of
+    CHUNK_MEMORY bytes, optional sample weights of the concatenated distances weight the mean and the SSE.
+    '''
+    max_dist, dist_sum, sse, total_weight, offset = 0., 0., 0., 0., 0
+    for cluster_dist in dist_list:
+        for block in chunk_slices(len(cluster_dist), 1):
+            block_dist = np.asarray(cluster_dist[block], dtype=np.float64)
+            if block_dist.size == 0:
+                continue
+            max_dist = max(max_dist, float(np.max(block_dist)))
+            if sample_weight is None:
+                dist_sum += np.sum(block_dist)
+                total_weight += block_dist.size
+                sse += weighted_sse(block_dist)
+            else:
+                weight = sample_weight[offset+block.start:offset+block.stop]
+                dist_sum += np.dot(block_dist, weight)
+                total_weight += np.sum(weight)
+                sse += weighted_sse(block_dist, weight)
+        offset += len(cluster_dist)
+    return dict(max_dist=max_dist, mean_dist=float(dist_sum/total_weight), sse=float(sse))
+
+def streamed_sse(trajs,cluster_centers,metric='euclidean',dtype=None):
+    '''
+    returns the within-cluster SSE of a list of (possibly memory mapped) trajectories with respect to the given
+    cluster centers, accumulated block by block without storing labels or distances
+    '''
+    sse = 0.
+    for traj_index, block, frames in iter_blocks(trajs, len(cluster_centers), dtype=dtype):
+        sse += weighted_sse(get_cluster_info(frames, cluster_centers, metric=metric, dtype=dtype)[1])
+    return sse
+
+def unique_frames(data,decimals=None):
+    '''
+    collapses duplicate rows of data into unique rows with counts, e.g. to cluster them with
+    KMeans.fit(sample_weight=counts), which gives the same centers as clustering all rows.
+    Args:
+        data: (n,d) ndarray or list of such arrays, which are concatenated
+        decimals: if given, the rows are rounded to this number of decimals before, so that near-identical rows
+        are collapsed as well
+    Returns:
+        unique: (m,d) ndarray of the unique (rounded) rows
+        counts: (m,) int ndarray of the number of occurrences of each unique row
+        inverse: (n,) int ndarray of the index of each row of data into unique, e.g. to map the cluster labels of
+        unique back to the data by labels[inverse]
+    '''
+    if type(data) is list:
+        data = concat_list(data)[0]
+    data = np.asarray(data)
+    if decimals is not None:
+        data = np.round(data, decimals)
+    unique, inverse, counts = np.unique(data, axis=0, return_inverse=True, return_counts=True)
+    return unique, counts, inverse.reshape(-1)
 
 def optimize_centroid(cluster_points):
     '''
@@ -338,58 +1998,205 @@ def optimize_centroid(cluster_points):
     centroid = np.divide(vecsum,cluster_points.shape[0])
     return centroid
 
-def set_new_cluster_centers(data,cluster_labels,k):
+def set_new_cluster_centers(data,cluster_labels,k,cluster_dist=None,sample_weight=None):
     '''
     for given data and clusterlabeling, construct new centers for each cluster
+
+    Per-cluster sums (in float64) and counts are accumulated in a single pass over the data. Clusters without any
+    assigned observation are reseeded to the observations farthest away from their current centers. With sample
+    weights the centers are the weighted means of their observations.
+
+    Args:
+        data: (n,d) ndarray
+        cluster_labels: (n,) integer ndarray with values in range(k)
+        k: int, number of clusters
+        cluster_dist: (n,) ndarray, distances of the observations to their assigned centers. Used to pick the
+            observations empty clusters are reseeded to. If None, the distances to the new centers are computed.
+        sample_weight: (n,) ndarray of non-negative weights of the observations or None
+
+    Returns:
+        (k,d) ndarray containing the new cluster centers
     '''
-    center_list = []
-    for i in range(k):
-        new_center = optimize_centroid(data[cluster_labels == i,:])
-        center_list.append(new_center)
+    sums, counts = cluster_sums(data, cluster_labels, k, sample_weight)
+    empty = counts == 0
+    cluster_centers = np.divide(sums, np.where(empty, 1, counts)[:, np.newaxis])
+    if np.any(empty):
+        cluster_centers = reseed_empty_clusters(data, cluster_centers, empty, cluster_dist)
+    return cluster_centers
 
-    return np.vstack(center_list)
+def cluster_sums(data,cluster_labels,k,sample_weight=None):
+    '''
+    returns the (k,d)-shaped per-cluster coordinate sums and the (k,)-shaped number of observations in each
+    cluster for given data and cluster labeling. With sample weights the sums are weighted and the counts are the
+    total weights of the clusters.
+    '''
+    cluster_labels = np.asarray(cluster_labels)
+    counts = np.bincount(cluster_labels, weights=sample_weight, minlength=k)
+    sums = np.empty((k, data.shape[1]))
+    for j in range(data.shape[1]):
+        weights = data[:, j] if sample_weight is None else data[:, j]*sample_weight
+        sums[:, j] = np.bincount(cluster_labels, weights=weights, minlength=k)
+    return sums, counts
+
+def reseed_empty_clusters(data,cluster_centers,empty,cluster_dist=None):
+    '''
+    moves the centers flagged in the boolean mask empty onto the observations farthest away from
+    their closest center, so that no cluster stays empty
+    '''
+    if cluster_dist is None:
+        cluster_dist = get_cluster_info(data, cluster_centers[~empty])[1]
+    n_empty = np.count_nonzero(empty)
+    farthest = np.argsort(cluster_dist)[::-1][:n_empty]
+    cluster_centers = np.array(cluster_centers, copy=True)
+    cluster_centers[np.flatnonzero(empty)[:len(farthest)]] = data[farthest]
+    return cluster_centers
 
-def initialize_centers(data,k,method):
+def initialize_centers(data,k,method,random_state=None,sample_weight=None):
     '''
-    initializes cluster centers with respect to given method
+    initializes cluster centers with respect to given method, optionally weighting the observations
     '''
 
     if method == 'forgy':
-        cluster_centers = forgy_centers(data,k)
+        cluster_centers = forgy_centers(data,k,random_state,sample_weight)
     elif method == 'kmeans++':
-        cluster_centers = kmeans_plusplus_centers(data,k)
+        cluster_centers = kmeans_plusplus_centers(data,k,random_state,sample_weight)
+    elif method == 'kmeans||':
+        cluster_centers = kmeans_parallel_centers(data,k,random_state=random_state,sample_weight=sample_weight)
+    else:
+        raise InvalidValue('Unknown initialization method %s' % method)
     return cluster_centers
 
+def subsample_indices(traj_lengths,stride=1,subsample=None,random_state=None):
+    '''
+    returns the sorted indices into the concatenation of trajectories with given lengths that select every
+    stride-th frame of each trajectory, starting with its first frame, and of these a random subset if subsample is
+    given.
+    Args:
+        traj_lengths: list of the numbers of frames of the trajectories
+        stride: int >= 1
+        subsample: None, int number of frames or float fraction of the strided frames in (0,1]
+        random_state: None, int seed or numpy.random.Generator used for subsample
+    '''
+    if int(stride) != stride or stride < 1:
+        raise InvalidValue('stride has to be a positive integer')
+    starts = np.cumsum(traj_lengths) - traj_lengths
+    indices = np.concatenate([np.arange(start, start+length, stride, dtype=np.intp)
+                              for start, length in zip(starts, traj_lengths)])
+    if subsample is None:
+        return indices
+    if isinstance(subsample, (int, np.integer)):
+        n_frames = subsample
+    elif 0 < subsample <= 1:
+        n_frames = max(1, int(round(subsample*len(indices))))
+    else:
+        raise InvalidValue('subsample has to be a number of frames or a fraction in (0,1]')
+    if n_frames < 1:
+        raise InvalidValue('subsample has to select at least one frame')
+    if n_frames >= len(indices):
+        return indices
+    return np.sort(check_random_state(random_state).choice(indices, n_frames, replace=False))
+
+def check_random_state(random_state=None):
+    '''
+    returns a numpy.random.Generator for None (freshly seeded), an int seed or an existing Generator
+    '''
+    if isinstance(random_state, np.random.Generator):
+        return random_state
+    return np.random.default_rng(random_state)
+
 #---------
 #cluster center initializations
 #---------
 
-def forgy_centers(data,k):
+def forgy_centers(data,k,random_state=None,sample_weight=None):
     '''
-    returns k randomly chosen cluster centers from data
+    returns k randomly chosen cluster centers from data, drawn with probabilities proportional to the optional
+    sample weights, of which at least k have to be positive
     '''
-    return sample(list(data),k)
+    random_state = check_random_state(random_state)
+    p = None if sample_weight is None else sample_weight/np.sum(sample_weight)
+    return data[np.sort(random_state.choice(data.shape[0], k, replace=False, p=p))]
 
 
-def kmeans_plusplus_centers(data,k):
+def kmeans_plusplus_centers(data,k,random_state=None,sample_weight=None,init_centers=None):
     '''
     returns cluster centers initialized by kmeans++ method,
     see http://ilpubs.stanford.edu:8090/778/1/2006-13.pdf
-    '''
-
-    index_vals = range(data.shape[0])
 
-    c1 = sample(list(data),1)
-    center_list = np.array(c1)
-    if k == 1:
-        return c1
-    while center_list.shape[0]<k:
-        labels,distances = get_cluster_info(data,center_list)
-        D2 = D2_weighting(distances)
-        distribution = rv_discrete(values=(index_vals,D2))
-        center_choice = np.array(data[distribution.rvs(size=1),:])
-        center_list = np.vstack([center_list,center_choice])
-    return np.array(center_list)
+    The squared distance of every observation to its closest chosen center is kept and updated with the distances
+    to each new center only, the next center is drawn by a binary search in the cumulative D^2 weights.
+    Optional sample weights multiply the D^2 weights, KMeans.fit requires at least k of them to be positive. Given
+    (m,d)-shaped init_centers are kept as the first m centers and only the remaining k-m centers are drawn.
+    '''
+    random_state = check_random_state(random_state)
+    n_samples = data.shape[0]
+    if sample_weight is None:
+        sample_weight = np.ones(n_samples)
+    n_given = 0 if init_centers is None else len(init_centers)
+    center_indices = np.empty(k - n_given, dtype=np.intp)
+    if init_centers is None:
+        center_indices[0] = _weighted_choice(sample_weight, random_state)
+        min_dist = np.full(n_samples, np.inf)
+        start = 1
+    else:
+        min_dist = np.square(get_cluster_info(data, init_centers)[1])
+        start = 0
+    for i in range(start, k - n_given):
+        if i > 0:
+            min_dist = np.minimum(min_dist, _squared_dist_to(data, data[center_indices[i-1]]))
+        center_indices[i] = _weighted_choice(min_dist*sample_weight, random_state)
+    if init_centers is None:
+        return np.array(data[center_indices])
+    return np.concatenate([init_centers, data[center_indices]])
+
+
+def kmeans_parallel_centers(data,k,oversampling=None,n_rounds=5,random_state=None,sample_weight=None):
+    '''
+    returns cluster centers initialized by the oversampling variant k-means|| of kmeans++,
+    see http://vldb.org/pvldb/vol5/p622_bahmanbahmani_vldb2012.pdf
+
+    Starting from one random center, each of n_rounds rounds draws every observation independently with probability
+    oversampling*D^2/sum(D^2) (default oversampling 2*k). The candidates are weighted by the number of observations
+    closest to them and reduced to k centers by weighted kmeans++, or filled up to k by random observations if there
+    are too few. Optional sample weights multiply the D^2 weights, count as multiplicities of the observations and
+    weight the random fill, at least k of them have to be positive.
+    '''
+    random_state = check_random_state(random_state)
+    if oversampling is None:
+        oversampling = 2*k
+    n_samples = data.shape[0]
+    if sample_weight is None:
+        candidates = [random_state.integers(n_samples)]
+    else:
+        candidates = [_weighted_choice(sample_weight, random_state)]
+    min_dist = _squared_dist_to(data, data[candidates[0]])
+    for i in range(n_rounds):
+        weighted_dist = min_dist if sample_weight is None else min_dist*sample_weight
+        cost = np.sum(weighted_dist)
+        if cost == 0:
+            break
+        chosen = np.flatnonzero(random_state.random(n_samples) < oversampling*weighted_dist/cost)
+        if chosen.size == 0:
+            continue
+        candidates.extend(chosen)
+        min_dist = np.minimum(min_dist, np.square(get_cluster_info(data, data[chosen])[1]))
+    candidates = np.unique(candidates)
+    if candidates.size == k:
+        return np.array(data[candidates])
+    if candidates.size < k:
+        remaining = np.setdiff1d(np.arange(n_samples), candidates)
+        n_fill = k - candidates.size
+        if sample_weight is None:
+            fill = random_state.choice(remaining, n_fill, replace=False)
+        else:
+            #as forgy_centers, only observations with positive weight are drawn
+            weights = sample_weight[remaining]
+            positive = weights > 0
+            fill = random_state.choice(remaining[positive], n_fill, replace=False,
+                                       p=weights[positive]/np.sum(weights[positive]))
+        return np.array(data[np.sort(np.concatenate([candidates, fill]))])
+    weights = np.bincount(get_cluster_info(data, data[candidates])[0], weights=sample_weight, minlength=candidates.size)
+    return kmeans_plusplus_centers(data[candidates], k, random_state, sample_weight=weights)
 
 
 def D2_weighting(dist_array):
@@ -403,6 +2210,19 @@ def D2_weighting(dist_array):
     D2 = np.divide(D2,sum)
     return D2
 
+def _squared_dist_to(data,point):
+    '''
+    returns the squared euclidean distances of all observations to a single point
+    '''
+    return np.square(distance.cdist(data, point.reshape(1, -1))[:, 0])
 
-
-
+def _weighted_choice(weights,random_state):
+    '''
+    draws one index with probability proportional to the given non-negative weights by binary search in their
+    cumulative sum. Falls back to a uniform choice if all weights are zero.
+    '''
+    cumulative = np.cumsum(weights)
+    if not cumulative[-1] > 0:
+        return random_state.integers(len(weights))
+    index = np.searchsorted(cumulative, random_state.random()*cumulative[-1], side='right')
+    return min(index, len(weights)-1)
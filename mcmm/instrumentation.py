@@ -0,0 +1,137 @@
+r"""
+This module provides the event interface of the clustering classes: listeners attached to an estimator receive
+a record for each iteration and phase of its fits.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+__metaclass__ = type
+from datetime import timedelta
+import pandas as pd
+
+
+class Instrumented(object):
+    '''
+    Base class of the estimators emitting fit records to listeners. A listener is a callable receiving one
+    record, a dict with the keys 'estimator' (class name) and 'event' and further fields depending on the event:
+
+        'iteration': iteration, wall_time and depending on the algorithm center_shift (largest center movement),
+            sse (within-cluster sum of squared errors of the assignment), n_centers
+        'phase': phase (e.g. 'initialization', 'iteration', 'assignment'), wall_time
+        'restart': restart, iterations, converged, sse, wall_time of one KMeans run
+        'fit': wall_time and the summary of the fit, e.g. iterations, converged, n_clusters, sse, max_dist,
+            mean_dist or noise_rate
+
+    Records are only created if a listener is attached (verbose=True attaches print_record), so fits without
+    listeners do not pay for the instrumentation.
+    '''
+
+    @property
+    def listeners(self):
+        '''list of the attached listeners'''
+        return self._listeners
+
+    def add_listener(self,listener):
+        '''
+        attaches a callable receiving the fit records, e.g. an EventCollector
+        '''
+        self._listeners.append(listener)
+
+    def remove_listener(self,listener):
+        self._listeners.remove(listener)
+
+    def _callback(self):
+        '''
+        returns the function emitting records to the current listeners (including print_record if verbose) as
+        callback(event, **fields), or None if there are no listeners
+        '''
+        listeners = list(self._listeners)
+        if self._verbose:
+            listeners.append(print_record)
+        if not listeners:
+            return None
+        estimator = type(self).__name__
+
+        def emit(event,**fields):
+            record = dict(estimator=estimator, event=event, **fields)
+            for listener in listeners:
+                listener(record)
+        return emit
+
+
+def print_record(record):
+    '''
+    listener printing the summary of a fit as the verbose estimators do
+    '''
+    if record['event'] != 'fit':
+        return
+    if record.get('converged'):
+        print('terminated by break condition')
+    if 'iterations' in record:
+        print('%s iterations until termination.' % str(record['iterations']))
+    if 'noise_rate' in record:
+        print('Detected %i clusters' % record['n_clusters'])
+    print('Finished after ' + str(timedelta(seconds=record['wall_time'])))
+    if 'noise_rate' in record:
+        print('Rate of noise in dataset: %f' % record['noise_rate'])
+    elif 'iterations' not in record:
+        print('%i cluster centers detected' % record['n_clusters'] + '\n')
+    if 'max_dist' in record:
+        print('max within-cluster distance to center: %f' % record['max_dist'])
+        print('mean within-cluster distance to center: %f' % record['mean_dist'])
+        print('sum of within cluster squared errors: %f' % record['sse'])
+
+
+class EventCollector(object):
+    '''
+    Listener storing all records it receives and aggregating them for performance monitoring:
+
+    >>> collector = EventCollector()
+    >>> clustering = KMeans(data, 10, verbose=False, listeners=[collector])
+    >>> clustering.fit()
+    >>> collector.report()
+    '''
+
+    #: record fields aggregated by report besides the wall time and how
+    aggregations = (('iterations', 'sum'), ('center_shift', 'last'), ('sse', 'last'), ('n_clusters', 'last'),
+                    ('noise_rate', 'last'))
+
+    def __init__(self):
+        self._records = []
+
+    def __call__(self,record):
+        self._records.append(record)
+
+    def __len__(self):
+        return len(self._records)
+
+    @property
+    def records(self):
+        '''list of all received records'''
+        return self._records
+
+    def clear(self):
+        self._records = []
+
+    def to_frame(self):
+        '''
+        returns the records as a pandas.DataFrame with one row per record
+        '''
+        return pd.DataFrame(self._records)
+
+    def report(self):
+        '''
+        returns a pandas.DataFrame with one row per estimator, event and phase containing the number of records,
+        the total, mean and maximal wall time and the aggregations of the other fields (see aggregations)
+        '''
+        frame = self.to_frame()
+        if frame.empty:
+            return frame
+        if 'phase' not in frame:
+            frame['phase'] = ''
+        frame['phase'] = frame['phase'].fillna('')
+        aggregations = dict(count=('wall_time', 'count'), wall_time_total=('wall_time', 'sum'),
+                            wall_time_mean=('wall_time', 'mean'), wall_time_max=('wall_time', 'max'))
+        for field, how in self.aggregations:
+            if field in frame:
+                aggregations[field] = (field, how)
+        return frame.groupby(['estimator', 'event', 'phase'], sort=False).agg(**aggregations)
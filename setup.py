@@ -11,13 +11,13 @@ setup(
     long_description=readme(),
     classifiers=[
         'Development Status :: 1 - Planning',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3'],
     url='https://github.com/Markov-Schmarkov/mcmm-project',
     author='',
     author_email='',
     packages=['mcmm'],
-    install_requires=['numpy', 'msmtools>=1.0', 'matplotlib', 'scipy', 'pandas'],
+    python_requires='>=3.5',
+    install_requires=['numpy>=1.17', 'msmtools>=1.0', 'matplotlib', 'scipy>=1.3', 'pandas>=0.25'],
     tests_require=['nose'],
     test_suite='nose.collector'
 )
@@ -0,0 +1,154 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+__metaclass__ = type
+
+from mcmm import DBSCAN as db
+import numpy as np
+from nose.tools import assert_true, assert_false, assert_equals, assert_raises
+from numpy.testing import assert_array_equal
+
+
+def blobs_with_noise(n=300):
+    centers = [(0,0),(3,0),(0,3)]
+    data = [0.3*np.random.randn(n,2) + center for center in centers]
+    data.append(np.random.uniform(-2,5,(n//5,2)))
+    return np.concatenate(data)
+
+def test_region_query_engines():
+    """KD-tree and brute force neighborhood queries should return the same strict eps-neighborhoods
+    """
+    data = np.round(np.random.rand(500,2),1)
+    for metric in ['euclidean','cityblock','chebyshev']:
+        tree = db.RegionQuery(data,0.2,metric,engine='tree')
+        brute = db.RegionQuery(data,0.2,metric,engine='brute')
+        assert_equals(tree.engine,'tree')
+        for region,region2 in zip(tree(range(500)),brute(range(500))):
+            assert_array_equal(region,region2)
+    assert_equals(db.RegionQuery(data,0.2,'cosine').engine,'brute')
+    assert_raises(db.InvalidValue,db.RegionQuery,data,0.2,'cosine','tree')
+
+def test_region_query_lattice():
+    """On lattice data with many pairs at or rounding around eps, the KD-tree neighborhoods and labels should be
+    those of cdist
+    """
+    data = np.round(np.random.rand(800,3),1)
+    reference = db.distance.cdist(data,data) < 0.3
+    for region, row in zip(db.RegionQuery(data,0.3,engine='tree')(range(800)),reference):
+        assert_array_equal(region,np.flatnonzero(row))
+    for minPts in [8,15]:
+        labels = db.DBSCAN(data,0.3,minPts,verbose=False,engine='tree').cluster_labels
+        assert_array_equal(labels,db.DBSCAN(data,0.3,minPts,verbose=False,engine='brute').cluster_labels)
+
+def test_dbscan_engines():
+    """Both engines should find the three blobs and agree on all labels
+    """
+    np.random.seed(0)
+    data = blobs_with_noise()
+    labels = db.DBSCAN(data,0.2,10,verbose=False,engine='tree').cluster_labels
+    labels2 = db.DBSCAN(data,0.2,10,verbose=False,engine='brute').cluster_labels
+    assert_array_equal(labels,labels2)
+    assert_equals(labels.dtype,np.int32)
+    assert_equals(set(labels),set([-1,0,1,2]))
+
+def test_dbscan_labels():
+    """Core points should be exactly the points with minPts neighbors, border points should be labeled like a core
+    point in their neighborhood and noise points should have no core point in their neighborhood
+    """
+    data = blobs_with_noise(100)
+    eps, minPts = 0.25, 8
+    clustering = db.DBSCAN(data,eps,minPts,verbose=False)
+    labels = clustering.cluster_labels
+    neighbors = np.linalg.norm(data[:,np.newaxis] - data[np.newaxis],axis=2) < eps
+    core = np.sum(neighbors,axis=1) >= minPts
+    assert_array_equal(clustering.core_sample_indices,np.flatnonzero(core))
+    assert_equals(clustering.n_clusters,labels.max() + 1)
+    for i in range(len(data)):
+        if labels[i] == -1:
+            assert_false(np.any(neighbors[i] & core))
+        else:
+            assert_true(np.any(neighbors[i] & core & (labels == labels[i])))
+    # the first point is visited as noise before the core point next to it is found
+    line = np.array([[0.],[0.15],[0.3],[0.45],[1.0]])
+    labels = db.DBSCAN(line,0.2,3,verbose=False).cluster_labels
+    assert_array_equal(labels,[0,0,0,0,-1])
+
+def test_dbscan_graph_engine():
+    """A shared neighborhood graph should reproduce the region query labels for different minPts
+    """
+    data = blobs_with_noise(200)
+    graph = db.NeighborhoodGraph(data,0.2)
+    assert_array_equal(graph.degrees,np.sum(np.linalg.norm(data[:,np.newaxis] - data[np.newaxis],axis=2) < 0.2,axis=1))
+    clustering = db.DBSCAN(data,0.2,3,verbose=False,graph=graph)
+    for minPts in [3,8,15]:
+        clustering.fit(minPts)
+        reference = db.DBSCAN(data,0.2,minPts,verbose=False)
+        assert_array_equal(clustering.cluster_labels,reference.cluster_labels)
+        assert_array_equal(clustering.core_sample_indices,reference.core_sample_indices)
+        assert_equals(clustering.n_clusters,reference.n_clusters)
+    assert_true(clustering.graph is graph)
+    assert_raises(db.InvalidValue,db.DBSCAN,data,0.3,3,graph=graph)
+
+def test_dbscan_list_and_transform():
+    """List data should be labeled in lists, transform should label points by their nearest core point within eps
+    """
+    data = blobs_with_noise(200)
+    trajs = [data[:300],data[300:]]
+    clustering = db.DBSCAN(trajs,0.2,8,verbose=False)
+    labels = clustering.cluster_labels
+    assert_equals([len(l) for l in labels],[300,len(data) - 300])
+    assert_array_equal(np.concatenate(labels),db.DBSCAN(data,0.2,8,verbose=False).cluster_labels)
+
+    core = clustering.core_sample_indices
+    new_labels = clustering.transform(trajs)
+    assert_array_equal(np.concatenate(new_labels)[core],np.concatenate(labels)[core])
+    far_away = np.array([[100.,100.],[-50.,0.]])
+    assert_array_equal(clustering.transform(far_away),[-1,-1])
+    for metric in ['euclidean','cosine']:
+        clustering = db.DBSCAN(data,0.2,8,metric=metric,verbose=False)
+        new_data = data + 0.01*np.random.randn(*data.shape)
+        core_points = data[clustering.core_sample_indices]
+        labels, dist = db.get_cluster_info(new_data,core_points,metric)
+        expected = np.where(dist < 0.2,clustering.cluster_labels[clustering.core_sample_indices][labels],-1)
+        assert_array_equal(clustering.transform(new_data),expected)
+
+def test_dbscan_grid_engine():
+    """The grid engine should reproduce the labels of the reference engines in two and three dimensions
+    """
+    np.random.seed(3)
+    for data, eps, minPts in [(blobs_with_noise(), 0.2, 8), (blobs_with_noise(), 0.1, 3),
+                              (np.round(np.random.rand(500,2),1), 0.15, 4),
+                              (np.concatenate([0.3*np.random.randn(300,3), np.random.uniform(-2,2,(50,3))]), 0.25, 5)]:
+        clustering = db.DBSCAN(data,eps,minPts,verbose=False,engine='grid')
+        reference = db.DBSCAN(data,eps,minPts,verbose=False,engine='tree')
+        assert_array_equal(clustering.cluster_labels,reference.cluster_labels)
+        assert_array_equal(clustering.core_sample_indices,reference.core_sample_indices)
+    lattice = np.round(np.random.rand(800,3),1)
+    for minPts in [12,18]:
+        clustering = db.DBSCAN(lattice,0.3,minPts,verbose=False,engine='grid')
+        reference = db.DBSCAN(lattice,0.3,minPts,verbose=False,engine='brute')
+        assert_array_equal(clustering.cluster_labels,reference.cluster_labels)
+        assert_array_equal(clustering.core_sample_indices,reference.core_sample_indices)
+    data = np.concatenate([0.3*np.random.randn(2000,3), np.random.uniform(-2,2,(200,3))])
+    reference = db.DBSCAN(data,0.2,6,verbose=False,engine='tree')
+    for batch_size, n_representatives in [(1,1),(7,2),(4096,4)]:
+        labels, core, n_clusters = db.grid_clusters(data,0.2,6,batch_size,n_representatives)
+        assert_array_equal(labels,reference.cluster_labels)
+        assert_array_equal(np.flatnonzero(core),reference.core_sample_indices)
+    assert_raises(db.InvalidValue,db.DBSCAN,np.random.rand(10,4),0.1,3,engine='grid')
+    assert_raises(db.InvalidValue,db.DBSCAN,data,0.1,3,metric='cityblock',engine='grid')
+
+def test_dbscan_single_precision():
+    """With dtype float32 all engines should give the labels of the single precision data, whose neighborhoods are
+    confirmed in double precision
+    """
+    np.random.seed(4)
+    data = (np.round(np.random.rand(600,2),1) + 0.01*np.random.randn(600,2)).astype(np.float32)
+    reference = db.DBSCAN(data.astype(np.float64),0.1,5,verbose=False,engine='brute')
+    for engine in ['tree','brute','graph','grid']:
+        clustering = db.DBSCAN(data,0.1,5,verbose=False,engine=engine,dtype=np.float32)
+        assert_equals(clustering.data.dtype,np.float32)
+        assert_array_equal(clustering.cluster_labels,reference.cluster_labels)
+        assert_array_equal(clustering.core_sample_indices,reference.core_sample_indices)
+    regions = db.RegionQuery(data,0.1,'cosine',engine='brute',dtype=np.float32)(range(50))
+    regions2 = db.RegionQuery(data.astype(np.float64),0.1,'cosine',engine='brute')(range(50))
+    for region, region2 in zip(regions,regions2):
+        assert_array_equal(region,region2)
@@ -7,9 +7,14 @@ import numpy as np
 import math
 import random
 import unittest
+import os
+import tempfile
+import itertools
+import tracemalloc
 from nose.tools import assert_true, assert_false, assert_equals, assert_raises
 from numpy.testing import assert_array_equal
 from mcmm import example as ex
+from mcmm.instrumentation import EventCollector
 from nose.tools import nottest
 
 
@@ -158,4 +163,530 @@ def test_find_cluster_center_multiple_trajectories1():
     cluster_labels = clustering.cluster_labels
     
     plt.scatter(cluster_centers[:,0],cluster_centers[:,1],c='r')
-    
\ No newline at end of file
+    
+def test_set_new_cluster_centers():
+    """The vectorized centroid update should agree with the per-cluster mean and reseed empty clusters
+    to the observation farthest from its center instead of producing NaN
+    """
+    data = np.random.rand(500,3)
+    k = 7
+    labels = np.random.randint(0,k,500)
+    centers = cl.set_new_cluster_centers(data,labels,k)
+    for i in range(k):
+        np.testing.assert_allclose(centers[i],cl.optimize_centroid(data[labels == i,:]))
+
+    labels[labels == 3] = 0
+    dist = np.random.rand(500)
+    centers = cl.set_new_cluster_centers(data,labels,k,dist)
+    assert_false(np.any(np.isnan(centers)))
+    assert_array_equal(centers[3],data[np.argmax(dist)])
+
+def test_minibatch_kmeans_list():
+    """Mini-batch KMeans should find the centers of well separated blobs and keep the list structure of the data
+    """
+    centers = np.array([[0.,0.],[10.,0.],[0.,10.]])
+    data = [centers[i%3] + 0.1*np.random.randn(1000,2) for i in range(6)]
+    clustering = cl.MiniBatchKMeans(data,3,batch_size=100,method='kmeans++',verbose=False)
+    cluster_labels = clustering.cluster_labels
+    assert_equals(len(cluster_labels),6)
+    for labels,dist in zip(cluster_labels,clustering.cluster_dist):
+        assert_equals(labels.shape,(1000,))
+        assert_equals(dist.shape,(1000,))
+    found = np.sort(np.round(clustering.cluster_centers).astype(int),axis=0)
+    assert_array_equal(found,np.sort(centers.astype(int),axis=0))
+
+def test_hamerly_matches_lloyd():
+    """Hamerly accelerated iterations should reproduce plain Lloyd iterations from the same initial centers
+    """
+    data = np.concatenate([np.random.randn(300,3) + 8*np.random.randn(3) for i in range(10)])
+    k = 12
+    init = np.array(cl.forgy_centers(data,k))
+    centers, counter, break_cond = cl.lloyd_iterate(data,init,k,100)
+    centers2, counter2, break_cond2 = cl.hamerly_iterate(data,init,k,100)
+    np.testing.assert_allclose(centers,centers2)
+    assert_equals(counter,counter2)
+    assert_raises(cl.InvalidValue,cl.KMeans,data,k,metric='cityblock',algorithm='hamerly')
+
+def test_hamerly_block_memory():
+    """For many centers the distances between the centers should be computed in blocks, so that the memory allocated
+    by the Hamerly iterations does not grow with the square of the number of centers
+    """
+    data = np.random.rand(3000,2)
+    k = 1500
+    budget = 2**20
+    default = cl.CHUNK_MEMORY
+    cl.CHUNK_MEMORY = budget
+    try:
+        tracemalloc.start()
+        cl.hamerly_iterate(data,data[:k],k,5)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        cl.CHUNK_MEMORY = default
+    assert_true(peak <= 4*budget)
+
+def test_get_cluster_info_chunked():
+    """Labels and distances should not depend on the memory budget used for the distance blocks
+    """
+    data = np.random.rand(1001,4)
+    centers = np.random.rand(13,4)
+    labels, dist = cl.get_cluster_info(data,centers)
+    for budget in [1,8*13*7,8*13*1000]:
+        labels2, dist2 = cl.get_cluster_info(data,centers,memory_budget=budget)
+        assert_array_equal(labels,labels2)
+        assert_array_equal(dist,dist2)
+    assert_equals(len(cl.chunk_slices(1001,13,8*13*100)),11)
+
+def test_get_cluster_info_block_memory():
+    """For few centers in many dimensions the blocks should be sized by the temporaries of the distance kernel, so
+    that the memory allocated by get_cluster_info stays within the budget
+    """
+    data = np.random.rand(4000,200)
+    centers = np.random.rand(2,200)
+    budget = 2**20
+    for dtype in [None,np.float32]:
+        tracemalloc.start()
+        cl.get_cluster_info(data,centers,memory_budget=budget,dtype=dtype)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert_true(peak <= budget + 16*data.shape[0])
+
+def test_kmeans_parallel_restarts():
+    """With several restarts the run with the lowest within-cluster SSE should be kept
+    """
+    data = np.concatenate([np.random.randn(200,2) + 8*np.random.randn(2) for i in range(5)])
+    clustering = cl.KMeans(data,5,n_init=4,n_jobs=2,verbose=False)
+    clustering.fit()
+    assert_equals(len(clustering.restart_times),4)
+    assert_equals(len(clustering.restart_sse),4)
+    np.testing.assert_allclose(np.sum(np.square(clustering.cluster_dist)),np.min(clustering.restart_sse))
+
+def test_center_initializations():
+    """Seeded initializations should be reproducible and return k distinct observations of the data
+    """
+    data = np.random.rand(1000,3)
+    for method in ['forgy','kmeans++','kmeans||']:
+        centers = cl.initialize_centers(data,20,method,random_state=42)
+        assert_equals(centers.shape,(20,3))
+        assert_equals(len(np.unique(centers,axis=0)),20)
+        assert_array_equal(centers,cl.initialize_centers(data,20,method,random_state=42))
+        labels, dist = cl.get_cluster_info(centers,data)
+        assert_true(np.all(dist == 0))
+    assert_raises(cl.InvalidValue,cl.initialize_centers,data,20,'random')
+
+def test_kmeans_out_of_core():
+    """Streaming .npy trajectories should give the same clustering as the in-memory list
+    """
+    trajs = [np.random.randn(500,2) + 6*np.random.randn(2) for i in range(3)]
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i,traj in enumerate(trajs):
+            paths.append(os.path.join(directory,'traj_%i.npy'%i))
+            np.save(paths[-1],traj)
+        init = np.array(cl.forgy_centers(np.concatenate(trajs),4))
+        centers = cl.lloyd_iterate(np.concatenate(trajs),init,4,100)[0]
+        centers2 = cl.streamed_lloyd_iterate(cl.open_trajectories(paths),init,4,100)[0]
+        np.testing.assert_allclose(centers,centers2)
+
+        clustering = cl.KMeans(paths,4,output_dir=directory,verbose=False)
+        cluster_labels = clustering.cluster_labels
+        assert_equals([len(labels) for labels in cluster_labels],[500,500,500])
+        assert_true(isinstance(cluster_labels[0],np.memmap))
+        assert_array_equal(np.load(os.path.join(directory,'labels_1.npy')),cluster_labels[1])
+        assert_array_equal(clustering.transform(trajs)[0][2],cluster_labels[2])
+        sse = np.sum(np.square(np.concatenate(clustering.cluster_dist)))
+        np.testing.assert_allclose(clustering.restart_sse,[sse])
+        clustering = cl.KMeans(paths,4,n_init=2,random_state=0,verbose=False)
+        clustering.fit()
+        sse = np.sum(np.square(np.concatenate(clustering.cluster_dist)))
+        np.testing.assert_allclose(min(clustering.restart_sse),sse)
+
+def test_regspace_block_screening():
+    """Block screening should select exactly the centers of the frame by frame regspace algorithm
+    """
+    data = np.cumsum(0.3*np.random.randn(3000,2),axis=0)
+    min_dist = 1.0
+    center_list = [data[0]]
+    for x in data[1:]:
+        if np.all(np.linalg.norm(np.array(center_list) - x,axis=1) > min_dist):
+            center_list.append(x)
+    for block_size in [1,10,1024]:
+        clustering = cl.Regspace([data[:1000],data[1000:]],5000,min_dist,verbose=False,block_size=block_size)
+        assert_array_equal(clustering.cluster_centers,np.array(center_list))
+    clustering = cl.Regspace(data,10,min_dist,verbose=False)
+    assert_array_equal(clustering.cluster_centers,np.array(center_list[:10]))
+
+def test_regspace_block_memory():
+    """The screening of the frames against many centers should stay within the memory budget, apart from the
+    buffers of the centers themselves
+    """
+    data = np.random.rand(5024,3)
+    budget = 2**24
+    default = cl.CHUNK_MEMORY
+    cl.CHUNK_MEMORY = budget
+    try:
+        tracemalloc.start()
+        centers = cl.regspace_centers([data],len(data),1e-9)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        cl.CHUNK_MEMORY = default
+    assert_equals(len(centers),len(data))
+    #the centers, their extended copy in the distance kernel and its temporaries are not part of the budget
+    assert_true(peak <= budget + 24*data.shape[0]*(data.shape[1] + 2))
+
+def test_regspace_grid():
+    """The grid indexed regspace should select the same centers and labels as the block screening
+    """
+    data = np.cumsum(0.3*np.random.randn(5000,3),axis=0)
+    for metric in ['euclidean','chebyshev']:
+        for max_centers in [50,5000]:
+            clustering = cl.Regspace(data,max_centers,0.5,metric=metric,verbose=False)
+            clustering2 = cl.Regspace(data,max_centers,0.5,metric=metric,verbose=False,algorithm='grid')
+            assert_array_equal(clustering.cluster_centers,clustering2.cluster_centers)
+            assert_array_equal(clustering.cluster_labels,clustering2.cluster_labels)
+            np.testing.assert_allclose(clustering.cluster_dist,clustering2.cluster_dist)
+    assert_raises(cl.InvalidValue,cl.Regspace,data,10,0.5,metric='cosine',algorithm='grid')
+    assert_raises(cl.InvalidValue,cl.Regspace(np.random.rand(100,5),10,0.5,verbose=False,algorithm='grid').fit)
+
+    grid = cl.GridIndex(0.5)
+    grid.add(clustering.cluster_centers)
+    points = np.cumsum(0.3*np.random.randn(1000,3),axis=0)
+    found = cl.get_cluster_info(points,clustering.cluster_centers)[1] <= 0.5
+    for memory_budget in [None,1,10000]:
+        assert_array_equal(grid.within(points,memory_budget=memory_budget),found)
+
+def test_regspace_transform():
+    """Regspace.transform should label new arrays and lists like a brute force nearest center search
+    """
+    data = np.cumsum(0.3*np.random.randn(2000,2),axis=0)
+    new_data = [np.cumsum(0.3*np.random.randn(500,2),axis=0) for i in range(3)]
+    for metric in ['euclidean','cosine']:
+        clustering = cl.Regspace(data,1000,0.5,metric=metric,verbose=False)
+        labels, dist = clustering.transform(new_data[0])
+        labels2, dist2 = cl.get_cluster_info(new_data[0],clustering.cluster_centers,metric)
+        assert_array_equal(labels,labels2)
+        np.testing.assert_allclose(dist,dist2)
+        labels_list, dist_list = clustering.transform(new_data)
+        assert_equals(len(labels_list),3)
+        assert_array_equal(labels_list[0],labels)
+
+def test_regspace_lattice_ties():
+    """On a lattice many frames are equally far from several centers. Block screening, grid screening and
+    get_cluster_info should give all of them to the first of these centers
+    """
+    axis = np.round(np.arange(12)*0.1,1)
+    data = np.array(list(itertools.product(axis,repeat=3)))
+    for metric in ['euclidean','cityblock','chebyshev']:
+        for min_dist in [0.15,0.25]:
+            clustering = cl.Regspace(data,1000,min_dist,metric=metric,verbose=False)
+            clustering2 = cl.Regspace(data,1000,min_dist,metric=metric,verbose=False,algorithm='grid')
+            assert_array_equal(clustering.cluster_centers,clustering2.cluster_centers)
+            for points in [data,data + 0.05]:
+                labels, dist = cl.get_cluster_info(points,clustering.cluster_centers,metric)
+                for result in [clustering.transform(points),clustering2.transform(points)]:
+                    assert_array_equal(result[0],labels)
+                    assert_array_equal(result[1],dist)
+            assert_array_equal(clustering.cluster_labels,clustering2.cluster_labels)
+
+def test_single_precision():
+    """With dtype float32 centers and distances should be single precision and match the float64 clustering
+    """
+    np.random.seed(5)
+    data = np.concatenate([0.3*np.random.randn(1000,3) + center for center in [(0,0,0),(4,0,0),(0,4,0)]]) + 50
+    distances = cl.pairwise_distances(data[:100],data[100:110],dtype=np.float32)
+    assert_equals(distances.dtype,np.float32)
+    np.testing.assert_allclose(distances,cl.pairwise_distances(data[:100],data[100:110]),atol=1e-3)
+    for algorithm in ['lloyd','hamerly']:
+        reference = cl.KMeans(data,3,method='kmeans++',algorithm=algorithm,random_state=0,verbose=False)
+        clustering = cl.KMeans(data,3,method='kmeans++',algorithm=algorithm,random_state=0,verbose=False,
+                               dtype=np.float32)
+        assert_equals(clustering.cluster_centers.dtype,np.float32)
+        assert_equals(clustering.cluster_dist.dtype,np.float32)
+        assert_array_equal(clustering.cluster_labels,reference.cluster_labels)
+        np.testing.assert_allclose(clustering.cluster_centers,reference.cluster_centers,rtol=1e-5)
+    for iterate in [cl.lloyd_iterate,cl.hamerly_iterate]:
+        for max_iter in [0,5]:
+            centers = iterate(data.astype(np.float32),data[:3],3,max_iter,dtype=np.float32)[0]
+            assert_equals(centers.dtype,np.float32)
+    reference = cl.Regspace([data[:1500],data[1500:]],100,1.0,verbose=False)
+    clustering = cl.Regspace([data[:1500],data[1500:]],100,1.0,verbose=False,dtype=np.float32)
+    assert_equals(clustering.cluster_centers.dtype,np.float32)
+    assert_equals(clustering.cluster_dist[0].dtype,np.float32)
+    assert_array_equal(np.concatenate(clustering.cluster_labels),np.concatenate(reference.cluster_labels))
+    assert_equals(clustering.transform(data)[1].dtype,np.float32)
+
+def test_threaded_transform():
+    """transform on several threads should give the same labels and distances as the serial transform
+    """
+    data = np.random.randn(3000,3)
+    new_data = np.random.randn(2001,3)
+    clustering = cl.KMeans(data,20,random_state=0,verbose=False)
+    labels, dist = clustering.transform(new_data)
+    for n_threads in [2,None]:
+        labels2, dist2 = clustering.transform(new_data,n_threads=n_threads)
+        assert_array_equal(labels2,labels)
+        assert_array_equal(dist2,dist)
+    labels_list, dist_list = clustering.transform([new_data[:500],new_data[500:]],n_threads=3)
+    assert_array_equal(np.concatenate(labels_list),labels)
+    assert_array_equal(np.concatenate(dist_list),dist)
+
+def test_transform_iter():
+    """transform_iter over chunks read from .npy and raw binary files should match transform of the whole data
+    """
+    data = np.random.randn(1000,2)
+    traj = np.random.randn(2500,2).astype(np.float32)
+    clustering = cl.KMeans(data,10,random_state=0,verbose=False)
+    labels, dist = clustering.transform(traj)
+    with tempfile.TemporaryDirectory() as directory:
+        npy_path = os.path.join(directory,'traj.npy')
+        raw_path = os.path.join(directory,'traj.bin')
+        np.save(npy_path,traj)
+        traj.tofile(raw_path)
+        for chunks in [cl.iter_trajectory_chunks(npy_path,chunk_size=300),
+                       cl.iter_trajectory_chunks(raw_path,chunk_size=1000,dtype=np.float32,dim=2)]:
+            results = list(clustering.transform_iter(chunks))
+            assert_true(len(results) > 1)
+            assert_array_equal(np.concatenate([result[0] for result in results]),labels)
+            assert_array_equal(np.concatenate([result[1] for result in results]),dist)
+        assert_equals(len(list(cl.iter_trajectory_chunks(npy_path))),1)
+        assert_raises(cl.InvalidValue,next,cl.iter_trajectory_chunks(raw_path))
+
+def test_warm_start_and_sse_curve():
+    """fit should start from given centers, sse_curve should return one SSE per k for warm started and
+    independent fits and keep the fit with the largest k
+    """
+    np.random.seed(2)
+    data = np.concatenate([0.2*np.random.randn(300,2) + center for center in [(0,0),(3,0),(0,3),(3,3)]])
+    centers = np.array([[0.,0.],[3.,0.],[0.,3.],[3.,3.]])
+    clustering = cl.KMeans(data,2,verbose=False)
+    clustering.fit(init_centers=centers + 0.5)
+    assert_equals(clustering.cluster_centers.shape,(4,2))
+    np.testing.assert_allclose(clustering.cluster_centers,centers,atol=0.1)
+    assert_raises(cl.InvalidValue,clustering.fit,3,None,centers)
+
+    more_centers = cl.kmeans_plusplus_centers(data,6,random_state=0,init_centers=centers)
+    assert_array_equal(more_centers[:4],centers)
+    assert_equals(more_centers.shape,(6,2))
+
+    for warm_start, n_jobs, stride in [(True,1,1),(True,2,1),(False,1,1),(False,2,1),(True,1,10),(False,2,10)]:
+        clustering = cl.KMeans(data,2,method='kmeans++',random_state=0,verbose=True,stride=stride,n_init=2)
+        sse = clustering.sse_curve([5,2,3,4],warm_start=warm_start,n_jobs=n_jobs)
+        assert_equals(len(sse),4)
+        assert_true(sse[1] > sse[2] > sse[3])
+        assert_equals(len(clustering.cluster_centers),5)
+        np.testing.assert_allclose(sse[0],np.sum(np.square(clustering.cluster_dist)))
+        assert_true(clustering._verbose)
+        assert_equals(clustering._n_jobs,1)
+    clustering = cl.MiniBatchKMeans(data,2,batch_size=100,verbose=False)
+    assert_equals(len(clustering.sse_curve([2,3],n_jobs=1)),2)
+    assert_raises(cl.InvalidValue,clustering.sse_curve,[2,3],n_jobs=2)
+
+def test_event_collector():
+    """listeners should receive iteration, phase, restart and fit records of KMeans and Regspace fits, which the
+    EventCollector aggregates per estimator, event and phase
+    """
+    np.random.seed(3)
+    data = np.concatenate([0.2*np.random.randn(200,2) + center for center in [(0,0),(3,0),(0,3)]])
+    collector = EventCollector()
+    for algorithm in ['lloyd','hamerly']:
+        clustering = cl.KMeans(data,3,algorithm=algorithm,random_state=0,verbose=False,listeners=[collector])
+        clustering.fit()
+        fit = collector.records[-1]
+        assert_equals(fit['event'],'fit')
+        assert_equals(fit['estimator'],'KMeans')
+        iterations = [record for record in collector.records if record['event'] == 'iteration']
+        assert_equals(len(iterations),fit['iterations'] + fit['converged'])
+        np.testing.assert_allclose(fit['sse'],np.sum(np.square(clustering.cluster_dist)))
+        collector.clear()
+    cl.Regspace(data,50,0.5,verbose=False,listeners=[collector]).fit()
+    cl.KMeans(data,3,verbose=False).fit()
+    assert_equals([record['event'] for record in collector.records][-3:],['phase','phase','fit'])
+    report = collector.report()
+    assert_equals(report.loc[('Regspace','fit',''),'count'],1)
+    assert_true(report.loc[('Regspace','phase','assignment'),'wall_time_total'] >= 0)
+    assert_equals(cl.KMeans(data,3,verbose=False)._callback(),None)
+
+def test_distance_kernel():
+    """The matrix product kernel should agree with cdist, give exact distances to the nearest centers and exact
+    strict neighborhoods, also for points at exactly the radius
+    """
+    data = np.random.randn(500,20) + 100
+    centers = data[:40]
+    for metric in ['euclidean','sqeuclidean','cityblock']:
+        kernel = cl.DistanceKernel(centers,metric)
+        reference = cl.distance.cdist(data,centers,metric)
+        np.testing.assert_allclose(kernel(data),reference,rtol=1e-8,atol=1e-6)
+        labels, dist = kernel.nearest(data)
+        assert_array_equal(labels,np.argmin(reference,axis=1))
+        assert_array_equal(dist[:40],0)
+    np.testing.assert_allclose(cl.pairwise_distances(data,centers,dtype=np.float32),
+                               cl.distance.cdist(data,centers),rtol=1e-3,atol=1e-2)
+    grid = np.round(np.random.rand(300,2),1)
+    regions = cl.DistanceKernel(grid).within(grid,0.2)
+    for region, row in zip(regions,cl.distance.cdist(grid,grid)):
+        assert_array_equal(region,np.flatnonzero(row < 0.2))
+
+def test_distance_kernel_lattice():
+    """On lattice data with many ties and distances at min_dist, nearest centers and regspace centers should be
+    those of cdist and the frame by frame regspace algorithm
+    """
+    data = np.round(np.random.rand(5000,3),1) + 100
+    centers = np.round(np.random.rand(200,3),1) + 100
+    reference = cl.distance.cdist(data,centers)
+    labels, dist = cl.get_cluster_info(data,centers)
+    assert_array_equal(labels,np.argmin(reference,axis=1))
+    assert_array_equal(dist,np.min(reference,axis=1))
+
+    data = np.round(2*np.random.rand(1500,3),1)
+    min_dist = 0.3
+    center_list = [data[0]]
+    for x in data[1:]:
+        if np.all(cl.distance.cdist(x[np.newaxis],np.array(center_list)) > min_dist):
+            center_list.append(x)
+    for algorithm in ['block','grid']:
+        clustering = cl.Regspace(data,5000,min_dist,verbose=False,block_size=64,algorithm=algorithm)
+        assert_array_equal(clustering.cluster_centers,np.array(center_list))
+
+def test_save_load():
+    """Saved models should restore centers, parameters and optionally memory mapped labels without the data and
+    assign new data like the original model
+    """
+    data = [np.random.rand(300,3),np.random.rand(200,3)]
+    with tempfile.TemporaryDirectory() as directory:
+        for clustering in [cl.KMeans(data,8,random_state=1,dtype=np.float32,verbose=False),
+                           cl.MiniBatchKMeans(data,8,batch_size=100,verbose=False),
+                           cl.Regspace(data,50,0.3,algorithm='grid',verbose=False)]:
+            path = os.path.join(directory,type(clustering).__name__)
+            clustering.save(path,labels=True)
+            loaded = cl.ClusteringBase.load(path + '.npz')
+            assert_equals(type(loaded),type(clustering))
+            assert_true(loaded.data is None)
+            assert_array_equal(loaded.cluster_centers,clustering.cluster_centers)
+            for labels, labels2 in zip(loaded.cluster_labels,clustering.cluster_labels):
+                assert_true(isinstance(labels,np.memmap))
+                assert_array_equal(labels,labels2)
+            new_data = np.random.rand(100,3)
+            for result, result2 in zip(loaded.transform(new_data),clustering.transform(new_data)):
+                assert_array_equal(result,result2)
+        clustering = cl.KMeans(data[0],4,verbose=False)
+        clustering.save(os.path.join(directory,'kmeans.npz'))
+        loaded = cl.KMeans.load(os.path.join(directory,'kmeans.npz'))
+        assert_raises(cl.InvalidOperation,lambda: loaded.cluster_labels)
+        assert_raises(cl.InvalidValue,cl.Regspace.load,os.path.join(directory,'kmeans.npz'))
+
+def test_stride_and_subsample():
+    """Strided and subsampled fits should choose the centers on the selected frames of each trajectory and assign
+    all frames afterwards
+    """
+    data = [np.random.rand(301,2),np.random.rand(150,2)]
+    strided = np.concatenate([traj[::3] for traj in data])
+    clustering = cl.KMeans(data,5,random_state=0,stride=3,verbose=False)
+    reference = cl.KMeans(strided,5,random_state=0,verbose=False)
+    np.testing.assert_allclose(clustering.cluster_centers,reference.cluster_centers)
+    assert_equals([len(labels) for labels in clustering.cluster_labels],[301,150])
+    assert_array_equal(np.concatenate(clustering.cluster_labels),
+                       cl.get_cluster_info(np.concatenate(data),clustering.cluster_centers)[0])
+    regspace = cl.Regspace(data,100,0.2,stride=3,verbose=False)
+    assert_array_equal(regspace.cluster_centers,cl.Regspace(strided,100,0.2,verbose=False).cluster_centers)
+
+    indices = cl.subsample_indices([301,150],3,0.5,random_state=0)
+    assert_equals(len(indices),76)
+    assert_true(np.all(np.diff(indices) > 0))
+    assert_true(np.all(np.isin(indices,np.concatenate([np.arange(0,301,3),np.arange(301,451,3)]))))
+    assert_raises(cl.InvalidValue,cl.subsample_indices,[10],0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory,'traj_%i.npy' % i) for i in range(2)]
+        for path, traj in zip(paths,data):
+            np.save(path,traj)
+        collector = EventCollector()
+        clustering = cl.KMeans(paths,5,algorithm='hamerly',subsample=100,random_state=0,verbose=False,
+                               listeners=[collector])
+        clustering.fit()
+        assert_equals(collector.records[0]['n_samples'],100)
+        assert_equals([len(labels) for labels in clustering.cluster_labels],[301,150])
+
+def test_sample_weight():
+    """A weighted fit of the unique frames should give the same centers as a fit of all frames, and zero weights
+    should exclude observations from the initialization
+    """
+    #distinct points on a lattice of side 1e-3, so that rounding to 6 decimals removes small perturbations
+    points = np.stack(divmod(np.random.choice(10**6,200,replace=False),1000),axis=1)/1000
+    data = points[np.repeat(np.arange(200),np.random.randint(1,6,200))]
+    unique, counts, inverse = cl.unique_frames([data[:300],data[300:]])
+    assert_equals(len(unique),200)
+    assert_array_equal(unique[inverse],data)
+    assert_equals(np.sum(counts),len(data))
+    assert_equals(len(cl.unique_frames(data + 1e-9*np.random.rand(*data.shape),decimals=6)[0]),200)
+
+    init_centers = points[:6]
+    for algorithm in ['lloyd','hamerly']:
+        full = cl.KMeans(data,6,algorithm=algorithm,verbose=False)
+        full.fit(init_centers=init_centers)
+        weighted = cl.KMeans(unique,6,algorithm=algorithm,verbose=False)
+        weighted.fit(init_centers=init_centers,sample_weight=counts)
+        np.testing.assert_allclose(weighted.cluster_centers,full.cluster_centers)
+        np.testing.assert_allclose(weighted.restart_sse,full.restart_sse)
+        assert_array_equal(weighted.cluster_labels[inverse],full.cluster_labels)
+
+    weights = np.zeros(200)
+    weights[:20] = 1
+    for method in ['forgy','kmeans++','kmeans||']:
+        centers = cl.initialize_centers(points,5,method,random_state=0,sample_weight=weights)
+        assert_true(np.all(cl.get_cluster_info(centers,points[:20])[1] == 0))
+    #few kmeans|| candidates on duplicated weighted observations are filled up with weighted ones only
+    duplicates = np.concatenate([np.repeat(points[:2],5,axis=0),points[10:]])
+    weights = np.zeros(200)
+    weights[:10] = 1
+    for seed in range(10):
+        centers = cl.kmeans_parallel_centers(duplicates,5,oversampling=0.5,random_state=seed,sample_weight=weights)
+        assert_true(np.all(cl.get_cluster_info(centers,points[:2])[1] == 0))
+    #the oversampling rounds may already find exactly k weighted candidates
+    weights = np.zeros(200)
+    weights[:5] = 1
+    centers = cl.kmeans_parallel_centers(points,5,random_state=0,sample_weight=weights)
+    assert_array_equal(centers,points[:5])
+    clustering = cl.KMeans(points,3,verbose=False)
+    assert_raises(cl.InvalidValue,clustering.fit,None,None,None,np.ones(10))
+    #every initialization method needs at least k observations with positive weight
+    weights = np.zeros(200)
+    weights[:2] = 1
+    for method in ['forgy','kmeans++','kmeans||']:
+        clustering = cl.KMeans(points,3,method=method,verbose=False)
+        assert_raises(cl.InvalidValue,clustering.fit,None,None,None,weights)
+    clustering.fit(init_centers=points[:3],sample_weight=weights)
+
+def test_bisecting_kmeans():
+    """Bisecting KMeans should build a binary tree with k leaves, assign fitted and new data by descending the
+    tree consistently with the list structure and restore the tree from a saved model
+    """
+    data = [np.random.rand(400,3),np.random.rand(250,3)]
+    collector = EventCollector()
+    clustering = cl.BisectingKMeans(data,12,random_state=0,verbose=False,listeners=[collector])
+    centers = clustering.cluster_centers
+    assert_equals(centers.shape,(12,3))
+    assert_equals(len(clustering.node_centers),23)
+    assert_equals(np.count_nonzero(clustering.node_children[:,0] < 0),12)
+    assert_array_equal(np.sort(clustering.node_clusters[clustering.node_clusters >= 0]),np.arange(12))
+    assert_equals([len(labels) for labels in clustering.cluster_labels],[400,250])
+    assert_equals(len([record for record in collector.records if record['event'] == 'iteration']),11)
+    labels, dist = clustering.transform(data[0])
+    assert_array_equal(labels,clustering.cluster_labels[0])
+    np.testing.assert_allclose(dist,np.sqrt(np.sum(np.square(data[0] - centers[labels]),axis=1)))
+    #the tree labels agree with the nearest centers for most observations
+    nearest = cl.get_cluster_info(np.concatenate(data),centers)[0]
+    assert_true(np.mean(np.concatenate(clustering.cluster_labels) == nearest) > 0.9)
+    nearest_clustering = cl.BisectingKMeans(data,12,random_state=0,assignment='nearest',verbose=False)
+    assert_array_equal(np.concatenate(nearest_clustering.cluster_labels),nearest)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory,'bisecting.npz')
+        clustering.save(path)
+        loaded = cl.ClusteringBase.load(path)
+    new_data = np.random.rand(100,3)
+    assert_array_equal(loaded.transform(new_data)[0],clustering.transform(new_data)[0])
+
+    duplicates = np.repeat(np.random.rand(3,2),10,axis=0)
+    assert_equals(len(cl.BisectingKMeans(duplicates,5,strategy='size',verbose=False).cluster_centers),3)
+    assert_raises(cl.InvalidValue,cl.BisectingKMeans,duplicates,5,strategy='random')